@@ -0,0 +1,567 @@
+"""
+Offline benchmarks for google_booklist
+
+Replays the recorded responses in saved_queries.py (and synthetic responses
+built from them) through an in-process stub transport and a local HTTP
+server, so no network access is needed. Results are emitted as JSON, tagged
+with the current commit, for comparison across commits.
+
+    python benchmarks.py [--scale N] [--queries N] [--latency-ms MS]
+                         [--sizes N,N,...] [--output FILE] [benchmark ...]
+"""
+import argparse
+import contextlib
+import gc
+import gzip
+import io
+import json
+import math
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import urllib.parse
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, Optional
+
+import requests
+
+from google_booklist import (Book, BookStore, BooksClient, ResponseCache,
+                             add_book_to_list, metrics, open_booklist,
+                             parse_json, query, query_many, view_list)
+from saved_queries import barbarian_query, lotr_query, mistborn_query
+
+RECORDED_QUERIES = {'mistborn': mistborn_query, 'lotr': lotr_query,
+                    'barbarian': barbarian_query}
+
+@dataclass
+class LegacyBook:
+    """
+    Book as it was before it was slotted, kept to compare against
+    """
+    title: str
+    authors: List[str]
+    publisher: str
+
+    def __init__(self, book):
+        self.title = book['volumeInfo'].get('title', "Unknown")
+        self.authors = book['volumeInfo'].get('authors', ["Unknown"])
+        self.publisher = book['volumeInfo'].get('publisher', "Unknown")
+
+    def __str__(self):
+        book_str = ("Title: "      + self.title +
+                   "\nAuthors: "   + ', '.join(self.authors) +
+                   "\nPublisher: " +  self.publisher + "\n\n")
+        return book_str
+
+@dataclass
+class UnslottedBook:
+    """
+    Book's current fields in a plain dataclass without slots or interning,
+    to separate what those save from the cost of the extra fields
+    """
+    title: str
+    authors: List[str]
+    publisher: str
+    id: Optional[str] = None
+    isbn_10: Optional[str] = None
+    isbn_13: Optional[str] = None
+    published_date: Optional[str] = None
+    page_count: Optional[int] = None
+
+    @classmethod
+    def from_volume(cls, book):
+        info = book['volumeInfo']
+        isbns = {identifier['type']: identifier['identifier']
+                 for identifier in info.get('industryIdentifiers', [])}
+        return cls(info.get('title', "Unknown"), info.get('authors', ["Unknown"]),
+                   info.get('publisher', "Unknown"), book.get('id'),
+                   isbns.get('ISBN_10'), isbns.get('ISBN_13'),
+                   info.get('publishedDate'), info.get('pageCount'))
+
+def synthetic_volumes(count):
+    """
+    Builds count distinct volumes shaped like the recorded API results
+
+    The volumes go through a JSON round trip so, as with a real response,
+    repeated author/publisher strings are separate objects.
+
+    Arguments:
+        count (int) - number of volumes to build
+    Returns:
+        List of volume dicts
+    """
+    return json.loads(synthetic_payload(count))
+
+def synthetic_payload(count):
+    """
+    Same volumes as synthetic_volumes(), as undecoded JSON
+    """
+    templates = (mistborn_query['items'] + lotr_query['items'] +
+                 barbarian_query['items'])
+    volumes = []
+    for i in range(count):
+        template = templates[i % len(templates)]
+        info = template['volumeInfo']
+        volumes.append(dict(template, id='synthetic{}'.format(i), volumeInfo=dict(
+            info, title='{} #{}'.format(info.get('title', 'Unknown'), i))))
+    return json.dumps(volumes)
+
+def synthetic_response(volumes, total_items=None):
+    """
+    Wraps volumes in a search response
+    """
+    return {'kind': 'books#volumes',
+            'totalItems': len(volumes) if total_items is None else total_items,
+            'items': volumes}
+
+def synthetic_books(count):
+    """
+    Generates count distinct Books without building volumes first, for
+    filling large booklists
+
+    Authors and publishers repeat, drawn from the recorded responses.
+    """
+    templates = Book.from_volumes(mistborn_query['items'] + lotr_query['items'] +
+                                  barbarian_query['items'])
+    for i in range(count):
+        template = templates[i % len(templates)]
+        yield Book('{} #{}'.format(template.title, i), template.authors,
+                   template.publisher, 'synthetic{}'.format(i),
+                   isbn_13=str(9780000000000 + i))
+
+class StubResponse:
+    """
+    Just enough of requests.Response for query()
+    """
+    def __init__(self, body):
+        self.status_code = 200
+        self.headers = {}
+        self.body = body
+
+    def json(self):
+        return json.loads(self.body)
+
+    @property
+    def content(self):
+        return self.body
+
+class StubTransport:
+    """
+    requests-style client answering from recorded payloads in-process
+
+    Responses are decoded on every call, as requests does, so query()
+    latency includes JSON decoding.
+    """
+    def __init__(self, payloads, fallback):
+        self.bodies = {term: json.dumps(payload).encode('utf-8')
+                       for term, payload in payloads.items()}
+        self.fallback = json.dumps(fallback).encode('utf-8')
+
+    def get(self, url, params=None, headers=None, **kwargs):
+        return StubResponse(self.bodies.get(params['q'], self.fallback))
+
+class RedirectedClient:
+    """
+    Sends requests query() makes to the Google Books API to url instead
+    """
+    def __init__(self, client, url):
+        self.client = client
+        self.url = url
+
+    def get(self, url, **kwargs):
+        return self.client.get(self.url, **kwargs)
+
+class RecordedBooksHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # Allows keep-alive connections
+    # Headers and body are separate writes; with Nagle on, the body waits
+    # for the client's delayed ACK on every kept-alive request
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        params = urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query)
+        body, compressed = self.server.bodies.get(params.get('q', [''])[0],
+                                                  self.server.fallback)
+        time.sleep(self.server.latency)
+        self.send_response(200)
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            body = compressed
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+@contextlib.contextmanager
+def stub_server(payloads, fallback, latency=0):
+    """
+    Serves recorded payloads from a local HTTP server, keyed by search term
+
+    Arguments:
+        payloads (dict) - search term -> response
+        fallback (dict) - response for any other search term
+        latency (float) - seconds each response is delayed, to stand in for
+                          the round trip to the real API
+    Returns:
+        Context manager giving the url to send searches to
+    """
+    def encode(payload):
+        body = json.dumps(payload).encode('utf-8')
+        return body, gzip.compress(body)
+    server = ThreadingHTTPServer(('127.0.0.1', 0), RecordedBooksHandler)
+    server.daemon_threads = True
+    server.bodies = {term: encode(payload) for term, payload in payloads.items()}
+    server.fallback = encode(fallback)
+    server.latency = latency
+    thread = threading.Thread(target=server.serve_forever, args=(0.05,), daemon=True)
+    thread.start()
+    try:
+        yield 'http://127.0.0.1:{}/books/v1/volumes'.format(server.server_port)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+class FirstOutput(io.TextIOBase):
+    """
+    Stand-in for stdout recording when something visible is first printed
+    """
+    def __init__(self):
+        self.first = None
+
+    def write(self, text):
+        if self.first is None and text.strip():
+            self.first = time.perf_counter()
+        return len(text)
+
+def first_output_seconds(function, *args, **kwargs):
+    """
+    Returns:
+        Seconds from calling function until it first prints something
+    """
+    output = FirstOutput()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(output):
+        function(*args, **kwargs)
+    return output.first - start
+
+def latency_summary(samples):
+    """
+    Summarizes latencies in seconds as milliseconds
+    """
+    if not samples:
+        return {'samples': 0}
+    # Nearest-rank percentiles; statistics.quantiles() needs two samples
+    # and python3.8
+    ordered = sorted(samples)
+
+    def percentile(p):
+        rank = max(math.ceil(p / 100 * len(ordered)), 1)
+        return round(ordered[rank - 1] * 1000, 3)
+    return {'samples': len(samples),
+            'mean_ms': round(statistics.mean(samples) * 1000, 3),
+            'p50_ms': percentile(50),
+            'p95_ms': percentile(95),
+            'p99_ms': percentile(99)}
+
+def timed(function, *args):
+    """
+    Times function with the garbage collector paused, so collections
+    triggered by earlier allocations don't land in the measurement
+
+    Returns:
+        (function's result, seconds it took)
+    """
+    gc.collect()
+    gc.disable()
+    try:
+        start = time.perf_counter()
+        result = function(*args)
+        return result, time.perf_counter() - start
+    finally:
+        gc.enable()
+
+def retained_bytes(function, *args):
+    """
+    Returns:
+        Bytes still allocated by function once it has returned, i.e. the
+        memory held by its result
+    """
+    gc.collect()
+    tracemalloc.start()
+    result = function(*args)
+    gc.collect()
+    allocated, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return allocated
+
+def bench_book_construction(options):
+    """
+    Compares building Books from volumes against the pre-slots class
+    (3 fields) and an unslotted class with the same 8 fields
+
+    Memory is what the books hold on to once the decoded response is
+    dropped, which is what a bulk import keeps around.
+    """
+    scale = options.scale
+    volumes = synthetic_volumes(scale)
+    payload = synthetic_payload(scale)
+    builders = {'legacy': lambda items: [LegacyBook(item) for item in items],
+                'unslotted': lambda items: [UnslottedBook.from_volume(item) for item in items],
+                'slotted': Book.from_volumes}
+    results = {}
+    for name, build in builders.items():
+        books, seconds = timed(build, volumes)
+        del books
+        held = retained_bytes(lambda: build(json.loads(payload)))
+        results[name] = {'books': scale,
+                         'books_per_second': round(scale / seconds),
+                         'bytes_per_book': round(held / scale)}
+    return results
+
+def bench_book_serialization(options):
+    """
+    Round trips Books through the JSON lines form
+    """
+    scale = options.scale
+    books = Book.from_volumes(synthetic_volumes(scale))
+    lines, dumped = timed(lambda: [book.to_json() for book in books])
+    loaded, seconds = timed(lambda: [Book.from_json(line) for line in lines])
+    assert loaded == books
+    return {'books': scale,
+            'bytes_per_book': round(sum(len(line) + 1 for line in lines) / scale),
+            'dump_books_per_second': round(scale / dumped),
+            'load_books_per_second': round(scale / seconds)}
+
+def bench_booklist_add(options):
+    """
+    Compares adding books to the booklist in one batch against one
+    transaction per book, and against the old one-open-per-book text file
+
+    The per-book variants are capped at 10000 books, since each one waits
+    for its own write to reach the disk.
+    """
+    books = Book.from_volumes(synthetic_volumes(options.scale))
+    per_book = books[:10000]
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        def legacy_text_append(books):
+            path = os.path.join(directory, 'booklist.txt')
+            for book in books:
+                with open(path, 'a+') as f:
+                    f.write(str(book))
+
+        def add_each(books):
+            with BookStore(os.path.join(directory, 'each.db')) as store:
+                for book in books:
+                    store.add(book)
+
+        def add_many(books):
+            with BookStore(os.path.join(directory, 'many.db')) as store:
+                store.add_many(books)
+
+        for name, add, sample in (('legacy_text_append', legacy_text_append, per_book),
+                                  ('add_each', add_each, per_book),
+                                  ('add_many', add_many, books)):
+            _, seconds = timed(add, sample)
+            results[name] = {'books': len(sample),
+                             'books_per_second': round(len(sample) / seconds)}
+    return results
+
+def bench_parse_json(options):
+    """
+    Parses full 40-item search responses into Books
+    """
+    responses = [synthetic_response(synthetic_volumes(40))
+                 for _ in range(max(options.scale // 40, 1))]
+    books, seconds = timed(lambda: [parse_json(r, limit=None) for r in responses])
+    count = sum(len(page) for page in books)
+    return {'responses': len(responses), 'books': count,
+            'books_per_second': round(count / seconds)}
+
+def bench_query_latency(options):
+    """
+    Measures query() latency for the recorded searches through the stub
+    transport, a response cache, and a local server with and without
+    connection pooling
+    """
+    terms = [list(RECORDED_QUERIES)[i % len(RECORDED_QUERIES)]
+             for i in range(options.queries)]
+    fallback = synthetic_response(synthetic_volumes(10))
+    results = {}
+    with stub_server(RECORDED_QUERIES, fallback) as url, BooksClient() as pooled:
+        variants = (
+            ('stub_transport', StubTransport(RECORDED_QUERIES, fallback), None),
+            ('cached', StubTransport(RECORDED_QUERIES, fallback), ResponseCache()),
+            ('local_server_pooled', RedirectedClient(pooled, url), None),
+            # requests.get opens a new connection for every search
+            ('local_server_unpooled', RedirectedClient(requests, url), None),
+        )
+        for name, client, cache in variants:
+            samples = []
+            for term in terms:
+                start = time.perf_counter()
+                assert query(term, cache=cache, client=client)
+                samples.append(time.perf_counter() - start)
+            results[name] = latency_summary(samples)
+    return results
+
+def bench_query_many(options):
+    """
+    Load tests query_many() with distinct searches against a local server
+    answering after options.latency_ms
+    """
+    terms = ['synthetic search {}'.format(i) for i in range(options.queries)]
+    fallback = synthetic_response(synthetic_volumes(10))
+    results = {}
+    with stub_server({}, fallback, options.latency_ms / 1000) as url:
+        for workers in (1, 8):
+            with BooksClient(pool_size=workers) as client:
+                batch, seconds = timed(lambda: list(query_many(
+                    terms, max_workers=workers, client=RedirectedClient(client, url))))
+            assert all(result.error is None for result in batch)
+            results['workers_{}'.format(workers)] = {
+                'terms': len(terms), 'terms_per_second': round(len(terms) / seconds)}
+    return results
+
+def bench_booklist_scaling(options):
+    """
+    Measures booklist operations as the booklist grows through options.sizes:
+        - opening it at startup
+        - duplicate checks and adding a book
+        - time until view_list() prints its first book, unsorted, sorted and
+          filtered
+    """
+    results = {}
+    probes = 100
+    for size in options.sizes:
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'booklist.db')
+            with BookStore(path) as store:
+                store.add_many(synthetic_books(size))
+            store, open_seconds = timed(open_booklist, path,
+                                        os.path.join(directory, 'missing.txt'))
+            with store:
+                existing = list(store.iter_books(limit=probes, offset=size // 2))
+                _, check_seconds = timed(lambda: [book in store for book in existing])
+                new_books = [Book('New {}'.format(i), ['New Author'], 'New Publisher',
+                                  'new{}'.format(i)) for i in range(probes)]
+                with contextlib.redirect_stdout(io.StringIO()):
+                    _, add_seconds = timed(lambda: [add_book_to_list(0, [book], store)
+                                                    for book in new_books])
+                first_output = {
+                    name: round(first_output_seconds(view_list, store, more=lambda: False,
+                                                     **view_options) * 1000, 3)
+                    for name, view_options in (
+                        ('unsorted', {}),
+                        ('sorted_by_title', {'sort': 'title'}),
+                        ('sorted_by_author', {'sort': 'author'}),
+                        ('filtered_by_author', {'filters': {'author': 'Tolkien'}}))}
+            results[str(size)] = {
+                'open_ms': round(open_seconds * 1000, 3),
+                'duplicate_check_ms': round(check_seconds / probes * 1000, 4),
+                'add_book_ms': round(add_seconds / probes * 1000, 4),
+                'view_first_output_ms': first_output}
+    return results
+
+def bench_metrics_overhead(options):
+    """
+    Measures what the instrumentation hooks cost, disabled and enabled:
+        - a timer() block plus a count() call on their own
+        - query() through the stub transport
+    """
+    calls = options.scale
+    transport = StubTransport(RECORDED_QUERIES, synthetic_response([]))
+
+    def hooks():
+        for _ in range(calls):
+            with metrics.timer('benchmark'):
+                pass
+            metrics.count('benchmark')
+
+    def queries():
+        for _ in range(options.queries):
+            query('mistborn', client=transport)
+
+    results = {}
+    for state in ('disabled', 'enabled'):
+        metrics.reset()
+        metrics.enabled = state == 'enabled'
+        _, hook_seconds = timed(hooks)
+        _, query_seconds = timed(queries)
+        results[state] = {'hooks_ns': round(hook_seconds / calls * 1e9),
+                          'query_ms': round(query_seconds / options.queries * 1000, 4)}
+    metrics.disable()
+    metrics.reset()
+    return results
+
+BENCHMARKS = {
+    'book_construction': bench_book_construction,
+    'book_serialization': bench_book_serialization,
+    'booklist_add': bench_booklist_add,
+    'parse_json': bench_parse_json,
+    'query_latency': bench_query_latency,
+    'query_many': bench_query_many,
+    'booklist_scaling': bench_booklist_scaling,
+    'metrics_overhead': bench_metrics_overhead,
+}
+
+def current_commit():
+    """
+    Returns:
+        Short hash of the checked out commit, None outside a git checkout
+    """
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                              capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def sizes(text):
+    return [int(size) for size in text.split(',')]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--scale', type=int, default=100000,
+                        help="number of books per benchmark (default: 100000)")
+    parser.add_argument('--queries', type=int, default=500,
+                        help="number of searches per query benchmark (default: 500)")
+    parser.add_argument('--latency-ms', type=float, default=20,
+                        help="simulated API latency for query_many (default: 20)")
+    parser.add_argument('--sizes', type=sizes, default=[1000, 10000, 100000],
+                        help="booklist sizes for booklist_scaling, comma separated "
+                             "(default: 1000,10000,100000; add 1000000 for the full run)")
+    parser.add_argument('--output', metavar='FILE',
+                        help="write results to FILE instead of stdout")
+    parser.add_argument('benchmarks', nargs='*', metavar='BENCHMARK',
+                        help="benchmarks to run, any of {} (default: all)".format(
+                            ', '.join(sorted(BENCHMARKS))))
+    args = parser.parse_args(argv)
+    # Checked here since argparse's choices reject an empty nargs='*' list
+    unknown = [name for name in args.benchmarks if name not in BENCHMARKS]
+    if unknown:
+        parser.error("unknown benchmark(s): {}".format(', '.join(unknown)))
+    report = {'commit': current_commit(),
+              'python': platform.python_version(),
+              'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+              'options': {'scale': args.scale, 'queries': args.queries,
+                          'latency_ms': args.latency_ms, 'sizes': args.sizes},
+              'results': {}}
+    for name in args.benchmarks or BENCHMARKS:
+        report['results'][name] = BENCHMARKS[name](args)
+    with (open(args.output, 'w') if args.output else contextlib.nullcontext(sys.stdout)) as f:
+        json.dump(report, f, indent=2)
+        f.write('\n')
+
+if __name__ == '__main__':
+    main()
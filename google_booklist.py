@@ -1,77 +1,1373 @@
+import argparse
+import asyncio
+import atexit
+import bisect
+import cProfile
+import email.utils
+import hashlib
+import json
 import os.path
+import pstats
+import random
 import re
 import requests
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager
 from dataclasses import dataclass, field
-from typing import List 
+from typing import List, Optional
 
-BOOKLIST = 'my_booklist.txt'
+BOOKLIST = 'my_booklist.db'
+LEGACY_BOOKLIST = 'my_booklist.txt'
+CACHE_DIR = '.booklist_cache'
+API_URL = "https://www.googleapis.com/books/v1/volumes"
+# Partial response projection with just the fields Book needs
+RESULT_FIELDS = ("totalItems,items(id,volumeInfo(title,authors,publisher,"
+                 "industryIdentifiers,publishedDate,pageCount))")
 
-@dataclass
+# Slots keep per-book memory down for bulk imports of many books
+@dataclass(init=False)
 class Book:
     """
     Object to keep track of the following book objects:
         - book's title
         - book's author 
         - publishing company
+        - Google Books volume id, ISBNs, publishing date and page count,
+          when known
     
+    Author and publisher strings are interned, since the same few of them
+    repeat across many books.
+
     Also provides string formatting for book object
     """
+    # Written out rather than dataclass(slots=True), which needs python3.10
+    __slots__ = ('title', 'authors', 'publisher', 'id', 'isbn_10', 'isbn_13',
+                 'published_date', 'page_count')
     title: str
     authors: List[str]
     publisher: str
+    id: Optional[str]
+    isbn_10: Optional[str]
+    isbn_13: Optional[str]
+    published_date: Optional[str]
+    page_count: Optional[int]
+
+    def __init__(self, title, authors, publisher, id=None, isbn_10=None,
+                 isbn_13=None, published_date=None, page_count=None):
+        self.title = title
+        self.authors = authors
+        self.publisher = publisher
+        self.id = id
+        self.isbn_10 = isbn_10
+        self.isbn_13 = isbn_13
+        self.published_date = published_date
+        self.page_count = page_count
+
+    @classmethod
+    def from_volume(cls, book):
+        """
+        Creates a Book from a volume in the API's search results
+
+        Arguments:
+            book (JSON object) - single entry of the results' items
+        Returns:
+            Book object
+        """
+        info = book['volumeInfo']
+        isbn_10 = isbn_13 = None
+        for identifier in info.get('industryIdentifiers', ()):
+            if identifier['type'] == 'ISBN_13':
+                isbn_13 = identifier['identifier']
+            elif identifier['type'] == 'ISBN_10':
+                isbn_10 = identifier['identifier']
+        return cls(info.get('title', "Unknown"),
+                   # "Unknown" single item in array to match type of authors
+                   list(map(sys.intern, info.get('authors', ("Unknown",)))),
+                   sys.intern(info.get('publisher', "Unknown")),
+                   book.get('id'), isbn_10, isbn_13,
+                   info.get('publishedDate'), info.get('pageCount'))
+
+    @classmethod
+    def from_volumes(cls, items):
+        """
+        Creates Books from a list of volumes in the API's search results
+
+        Arguments:
+            items (List[JSON object]) - the results' items
+        Returns:
+            List of Book objects
+        """
+        from_volume = cls.from_volume
+        return [from_volume(item) for item in items]
 
-    def __init__(self, book):
-        self.title = book['volumeInfo'].get('title', "Unknown")
-        # "Unknown" single item in array to match type of authors
-        self.authors = book['volumeInfo'].get('authors', ["Unknown"])
-        self.publisher = book['volumeInfo'].get('publisher', "Unknown")
+    def to_json(self):
+        """
+        Serializes the book as a compact JSON array, one line per book
+
+        Returns:
+            JSON string with the fields in declaration order
+        """
+        return json.dumps([self.title, self.authors, self.publisher, self.id,
+                           self.isbn_10, self.isbn_13, self.published_date,
+                           self.page_count],
+                          ensure_ascii=False, separators=(',', ':'))
+
+    @classmethod
+    def from_json(cls, line):
+        """
+        Creates a Book from a line written by to_json()
+
+        Arguments:
+            line (str) - JSON array of the book's fields
+        Returns:
+            Book object
+        """
+        title, authors, publisher, *rest = json.loads(line)
+        return cls(title, list(map(sys.intern, authors)), sys.intern(publisher), *rest)
 
     def __str__(self):
-        book_str = ("Title: "      + self.title + 
-                   "\nAuthors: "   + ', '.join(self.authors) +
-                   "\nPublisher: " +  self.publisher + "\n\n")
-        return book_str
+        return "Title: {}\nAuthors: {}\nPublisher: {}\n\n".format(
+            self.title, ', '.join(self.authors), self.publisher)
+
+def write_books(books, f):
+    """
+    Writes books to a file object as JSON lines
+
+    Arguments:
+        books (iterable of Book) - books to write
+        f (file object) - text file opened for writing
+    Returns:
+        Number of books written
+    """
+    count = 0
+    for book in books:
+        f.write(book.to_json() + '\n')
+        count += 1
+    return count
+
+def read_books(f):
+    """
+    Reads books written by write_books()
+
+    Arguments:
+        f (file object) - text file opened for reading
+    Returns:
+        Generator of Book objects
+    """
+    for line in f:
+        if line.strip():
+            yield Book.from_json(line)
+
+@dataclass
+class StageStats:
+    """
+    Timings recorded for one stage of the pipeline:
+        - number of times it ran and their total duration
+        - how many runs fell in each of Metrics.BUCKETS (plus one overflow)
+    """
+    count: int = 0
+    total_seconds: float = 0.0
+    buckets: List[int] = field(default_factory=list)
+
+class _StageTimer:
+    __slots__ = ('metrics', 'stage', 'start')
+
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.observe(self.stage, time.perf_counter() - self.start)
+
+class _NullTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+_NULL_TIMER = _NullTimer()
+
+class Metrics:
+    """
+    Opt-in per-stage timers and counters for the search/add pipeline
+
+    Stages timed: request, decode, parse, booklist_open, booklist_write.
+    Counters: cache_hits, cache_misses, cache_revalidations,
+    bytes_downloaded, items_parsed, books_added, booklist_bytes_written.
+
+    While disabled (the default) timer() hands back a shared no-op object
+    and count() returns straight away, so the hooks cost next to nothing.
+    """
+    # Upper bounds, in seconds, of the latency histogram buckets
+    BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self):
+        self.enabled = False
+        self._lock = threading.Lock()
+        self.reset()
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        """
+        Forgets everything recorded so far
+        """
+        with self._lock:
+            self.counters = {}
+            self.stages = {}
+
+    def timer(self, stage):
+        """
+        Times a stage of the pipeline
+
+        Arguments:
+            stage (str) - name of the stage
+        Returns:
+            Context manager recording how long its block took
+        """
+        if not self.enabled:
+            return _NULL_TIMER
+        return _StageTimer(self, stage)
+
+    def count(self, name, amount=1):
+        """
+        Adds amount to the counter called name
+        """
+        if self.enabled:
+            with self._lock:
+                self.counters[name] = self.counters.get(name, 0) + amount
+
+    def observe(self, stage, seconds):
+        """
+        Records one run of stage that took seconds
+        """
+        with self._lock:
+            stats = self.stages.get(stage)
+            if stats is None:
+                stats = self.stages[stage] = StageStats(
+                    buckets=[0] * (len(self.BUCKETS) + 1))
+            stats.count += 1
+            stats.total_seconds += seconds
+            stats.buckets[bisect.bisect_left(self.BUCKETS, seconds)] += 1
+
+    def snapshot(self):
+        """
+        Returns:
+            Dict of counters and per-stage count, total seconds and
+            cumulative histogram buckets (keyed by upper bound)
+        """
+        with self._lock:
+            stages = {}
+            for stage, stats in self.stages.items():
+                cumulative, total = {}, 0
+                for bound, bucket in zip(self.BUCKETS + ('+Inf',), stats.buckets):
+                    total += bucket
+                    cumulative[str(bound)] = total
+                stages[stage] = {'count': stats.count,
+                                 'total_seconds': stats.total_seconds,
+                                 'buckets': cumulative}
+            return {'counters': dict(self.counters), 'stages': stages}
+
+    def to_prometheus(self):
+        """
+        Returns:
+            Snapshot in the Prometheus text exposition format
+        """
+        snapshot = self.snapshot()
+        lines = []
+        for name, value in sorted(snapshot['counters'].items()):
+            lines.append("# TYPE google_booklist_{}_total counter".format(name))
+            lines.append("google_booklist_{}_total {}".format(name, value))
+        if snapshot['stages']:
+            lines.append("# TYPE google_booklist_stage_seconds histogram")
+        for stage, stats in sorted(snapshot['stages'].items()):
+            for bound, count in stats['buckets'].items():
+                lines.append('google_booklist_stage_seconds_bucket{{stage="{}",le="{}"}} {}'
+                             .format(stage, bound, count))
+            lines.append('google_booklist_stage_seconds_sum{{stage="{}"}} {}'
+                         .format(stage, stats['total_seconds']))
+            lines.append('google_booklist_stage_seconds_count{{stage="{}"}} {}'
+                         .format(stage, stats['count']))
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        """
+        Returns:
+            Human readable table of stage timings and counters
+        """
+        snapshot = self.snapshot()
+        lines = ["{:<16}{:>8}{:>12}{:>12}".format("Stage", "Count", "Total (s)", "Mean (ms)")]
+        for stage, stats in sorted(snapshot['stages'].items()):
+            lines.append("{:<16}{:>8}{:>12.3f}{:>12.3f}".format(
+                stage, stats['count'], stats['total_seconds'],
+                stats['total_seconds'] / stats['count'] * 1000))
+        for name, value in sorted(snapshot['counters'].items()):
+            lines.append("{:<24}{:>12}".format(name, value))
+        return '\n'.join(lines)
+
+    def write(self, path):
+        """
+        Exports a snapshot to path
+
+        Files ending in .prom are replaced with Prometheus text (for a
+        textfile collector); anything else gets a JSON line appended.
+        """
+        if path.endswith('.prom'):
+            # Write then rename so a collector never reads half a file
+            with open(path + '.tmp', 'w') as f:
+                f.write(self.to_prometheus())
+            os.replace(path + '.tmp', path)
+        else:
+            with open(path, 'a') as f:
+                f.write(json.dumps(dict(self.snapshot(), timestamp=time.time())) + '\n')
+
+# Instrumentation shared by the whole module, off unless enabled
+metrics = Metrics()
 
-def query(search_term):
+def enable_instrumentation(profile=False, metrics_path=None):
+    """
+    Turns on metrics (and optionally cProfile) for the rest of the session
+
+    Arguments:
+        profile (bool) - profile with cProfile and print a report on exit
+        metrics_path (str) - file metrics are exported to on exit
+    Returns:
+        Nothing
+    Side Effects:
+        Registers an exit handler printing/writing the reports
+    """
+    metrics.enable()
+    profiler = cProfile.Profile() if profile else None
+    thread_profilers = []
+
+    def profile_thread(*args):
+        # Runs on the first event of each new thread (query_many() workers,
+        # prefetching) and hands the thread over to its own profiler
+        thread_profiler = cProfile.Profile()
+        try:
+            thread_profiler.enable()
+        except ValueError:
+            # Python 3.12+ profilers already see every thread
+            sys.setprofile(None)
+            return
+        thread_profilers.append(thread_profiler)
+
+    def report():
+        if profiler is not None:
+            threading.setprofile(None)
+            profiler.disable()
+            stats = pstats.Stats(profiler, *thread_profilers, stream=sys.stderr)
+            stats.sort_stats('cumulative').print_stats(25)
+            print(metrics.summary(), file=sys.stderr)
+        if metrics_path:
+            metrics.write(metrics_path)
+    atexit.register(report)
+    if profiler is not None:
+        threading.setprofile(profile_thread)
+        profiler.enable()
+
+@dataclass
+class CacheEntry:
+    """
+    Cached query response along with the ETag and time it was stored
+    """
+    body: dict
+    etag: Optional[str]
+    stored_at: float
+
+class ResponseCache:
+    """
+    Caches query responses so repeated searches don't hit the API:
+        - in-memory LRU of at most max_entries responses
+        - optional on-disk store in directory, at most max_disk_entries files
+
+    Entries are keyed by normalized search term and request params. Entries
+    older than ttl seconds are stale; a stale entry with an ETag is
+    revalidated with If-None-Match instead of being downloaded again.
+
+    If the directory can't be written to (removed, disk full...), the cache
+    carries on in memory only.
+    """
+    def __init__(self, max_entries=128, ttl=3600, directory=None,
+                 max_disk_entries=1024, clock=time.time):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.directory = directory
+        self.max_disk_entries = max_disk_entries
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self._entries = OrderedDict()
+        # Shared by query_many() worker threads; never held during file I/O
+        self._lock = threading.RLock()
+        self._disk_entries = 0 # Files in directory, as far as we know
+        if directory:
+            try:
+                os.makedirs(directory, exist_ok=True)
+                self._disk_entries = sum(1 for f in os.scandir(directory)
+                                         if f.name.endswith('.json'))
+            except OSError:
+                self.directory = None
+
+    @staticmethod
+    def make_key(search_term, params=None):
+        """
+        Builds a cache key from a search term and any extra request params
+
+        Arguments:
+            search_term (str) - string to be searched
+            params (dict) - additional request parameters
+        Returns:
+            String key, identical for searches differing only in case/spacing
+        """
+        term = ' '.join(search_term.lower().split())
+        return json.dumps([term, sorted((params or {}).items())])
+
+    def get(self, key):
+        """
+        Returns the cached response for key if it is still fresh
+
+        Arguments:
+            key (str) - key from make_key()
+        Returns:
+            JSON representation of search query results, or None on a miss
+        Side Effects:
+            Updates hit/miss counters and LRU order
+        """
+        entry = self._lookup(key)
+        with self._lock:
+            if entry is not None and self.clock() - entry.stored_at < self.ttl:
+                self.hits += 1
+                return entry.body
+            self.misses += 1
+            return None
+
+    def entry(self, key):
+        """
+        Returns the (possibly stale) CacheEntry for key, if any
+        """
+        return self._lookup(key)
+
+    def revalidate(self, key, entry):
+        """
+        Marks a stale entry as fresh again after the API answered 304
+
+        Arguments:
+            key (str) - key from make_key()
+            entry (CacheEntry) - stale entry whose ETag was sent; it may have
+                                 been evicted since, so it is stored again
+        Returns:
+            JSON representation of the cached search query results
+        """
+        with self._lock:
+            self.revalidations += 1
+        self.put(key, entry.body, entry.etag)
+        return entry.body
+
+    def put(self, key, body, etag=None):
+        """
+        Stores a response in memory and, if configured, on disk
+
+        Side Effects:
+            Evicts least recently used entries past max_entries and, once
+            there are more than max_disk_entries files, the oldest files
+        """
+        entry = CacheEntry(body, etag, self.clock())
+        with self._lock:
+            self._remember(key, entry)
+            directory = self.directory
+        if not directory:
+            return
+        path = self._path(directory, key)
+        temp_path = None
+        try:
+            existed = os.path.exists(path)
+            # Write then rename so other sessions never read half a file
+            fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+            with open(fd, 'w') as f:
+                json.dump({'key': key, 'etag': etag,
+                           'stored_at': entry.stored_at, 'body': body}, f)
+            os.replace(temp_path, path)
+        except OSError:
+            # A failed write shouldn't fail the search that downloaded body
+            with self._lock:
+                self.directory = None
+            if temp_path is not None:
+                try:
+                    os.remove(temp_path)
+                except OSError:
+                    pass
+            return
+        with self._lock:
+            self._disk_entries += not existed
+            evict = self._disk_entries > self.max_disk_entries
+            if evict:
+                # Claimed here so other threads don't scan at the same time
+                self._disk_entries = self.max_disk_entries
+        if evict:
+            self._evict_disk(directory)
+
+    def stats(self):
+        """
+        Returns hit/miss/revalidation counters as a dict
+        """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'revalidations': self.revalidations,
+                    'entries': len(self._entries)}
+
+    def _lookup(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+            directory = self.directory
+        if not directory:
+            return None
+        try:
+            with open(self._path(directory, key), 'r') as f:
+                stored = json.load(f)
+            entry = CacheEntry(stored['body'], stored['etag'], stored['stored_at'])
+        except (OSError, ValueError, KeyError, TypeError):
+            # Missing (e.g. evicted by another session) or unreadable
+            # files are just a miss; put() will overwrite them
+            return None
+        with self._lock:
+            # Another thread may have stored a newer response meanwhile
+            if key not in self._entries:
+                self._remember(key, entry)
+            return self._entries[key]
+
+    def _remember(self, key, entry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    @staticmethod
+    def _path(directory, key):
+        name = hashlib.sha1(key.encode('utf-8')).hexdigest() + '.json'
+        return os.path.join(directory, name)
+
+    def _evict_disk(self, directory):
+        # Removes the oldest files down to 90% of max_disk_entries, so a full
+        # cache isn't rescanned on every put(). Other sessions may delete
+        # files while we look at them.
+        files = []
+        try:
+            for f in os.scandir(directory):
+                if f.name.endswith('.json'):
+                    try:
+                        files.append((f.stat().st_mtime, f.path))
+                    except OSError:
+                        pass
+        except OSError:
+            return
+        keep = self.max_disk_entries - self.max_disk_entries // 10
+        files.sort()
+        for _, path in files[:max(len(files) - keep, 0)]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        with self._lock:
+            self._disk_entries = min(len(files), keep)
+
+class BooksClient:
+    """
+    Reusable HTTP client for the Google Books API
+
+    Wraps a requests.Session so connections are pooled and kept alive between
+    searches, negotiates gzip responses, and retries 429/503 responses with
+    exponential backoff and jitter, honoring Retry-After when it is sent.
+    """
+    RETRY_STATUSES = (429, 503)
+
+    def __init__(self, timeout=10, max_retries=3, backoff=0.5, max_backoff=30,
+                 pool_size=10, sleep=time.sleep):
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.sleep = sleep
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size,
+                                                pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        # Google only compresses responses for user agents mentioning gzip
+        self.session.headers.update({'Accept-Encoding': 'gzip',
+                                     'User-Agent': 'google_booklist (gzip)'})
+
+    def get(self, url, params=None, headers=None, **kwargs):
+        """
+        Makes a GET request, retrying rate limited/unavailable responses
+
+        Arguments:
+            url (str) - url to request
+            params (dict) - query string parameters
+            headers (dict) - extra request headers
+        Returns:
+            requests.Response of the last attempt
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        for attempt in range(self.max_retries + 1):
+            response = self.session.get(url, params=params, headers=headers, **kwargs)
+            if (response.status_code not in self.RETRY_STATUSES
+                    or attempt == self.max_retries):
+                return response
+            delay = self._retry_delay(attempt, response)
+            response.close() # Hand the connection back to the pool
+            self.sleep(delay)
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _retry_delay(self, attempt, response):
+        retry_after = response.headers.get('Retry-After')
+        if retry_after:
+            if retry_after.isdigit():
+                return min(int(retry_after), self.max_backoff)
+            try:
+                retry_at = email.utils.parsedate_to_datetime(retry_after)
+                return min(max(retry_at.timestamp() - time.time(), 0), self.max_backoff)
+            except (TypeError, ValueError):
+                pass # Unparseable Retry-After, fall back to backoff
+        # Full jitter keeps concurrent clients from retrying in lockstep
+        return random.uniform(0, min(self.backoff * 2 ** attempt, self.max_backoff))
+
+_default_client = None
+_default_client_lock = threading.Lock()
+
+def get_client():
+    """
+    Returns the BooksClient shared by query() and batch callers
+
+    Returns:
+        BooksClient, created on first use
+    """
+    global _default_client
+    with _default_client_lock:
+        if _default_client is None:
+            _default_client = BooksClient()
+    return _default_client
+
+def _response_size(response):
+    # Bytes received over the wire; gzipped bodies are several times larger
+    # once decompressed into response.content
+    length = response.headers.get('Content-Length')
+    if length and length.isdigit():
+        return int(length)
+    raw = getattr(response, 'raw', None)
+    if hasattr(raw, 'tell'):
+        return raw.tell() # Chunked responses have no Content-Length
+    return len(response.content)
+
+def query(search_term, cache=None, client=None, start_index=0, max_results=None,
+          fields=None):
     """
     Makes a query to the Google Books API with the provided search_term
 
     Arguments:
         search_term (str) - string to be searched
+        cache (ResponseCache) - optional cache consulted before the API
+        client - object with a requests-style get() used to make the request,
+                 defaults to the shared BooksClient
+        start_index (int) - index of the first result to return
+        max_results (int) - number of results to return (API allows up to 40)
+        fields (str) - partial response projection, e.g. RESULT_FIELDS
     Returns:
         JSON representation of search query results
     """    
-    search_results = requests.get(url="https://www.googleapis.com/books/v1/volumes", 
-                                  params={"q" : search_term})
+    if client is None:
+        client = get_client()
+    extra_params = {}
+    if start_index:
+        extra_params["startIndex"] = start_index
+    if max_results is not None:
+        extra_params["maxResults"] = max_results
+    if fields is not None:
+        extra_params["fields"] = fields
+    params = dict({"q" : search_term}, **extra_params)
+    headers = {}
+    stale = None
+    if cache is not None:
+        key = cache.make_key(search_term, extra_params)
+        cached = cache.get(key)
+        if cached is not None:
+            metrics.count('cache_hits')
+            return cached
+        metrics.count('cache_misses')
+        # Kept for a 304, in case the entry is evicted while we wait
+        stale = cache.entry(key)
+        if stale is not None and stale.etag:
+            headers["If-None-Match"] = stale.etag
+    with metrics.timer('request'):
+        search_results = client.get(url=API_URL, params=params, headers=headers)
+    # Status Code 304 means our stale cached copy is still current
+    if stale is not None and search_results.status_code == 304:
+        metrics.count('cache_revalidations')
+        return cache.revalidate(key, stale)
     # Status Code 200 indicates successful request
     if search_results.status_code == 200:
-        return search_results.json()
+        with metrics.timer('decode'):
+            results = search_results.json()
+        if metrics.enabled:
+            metrics.count('bytes_downloaded', _response_size(search_results))
+        if cache is not None:
+            cache.put(key, results, search_results.headers.get("ETag"))
+        return results
     else:
         return None
 
-def parse_json(json_results):
+def parse_json(json_results, limit=5):
     """
-    Parses firts 5 elements of JSON object into a book object
+    Parses the first limit elements of JSON object into book objects
 
     Arguments:
         json_results (JSON object) - JSON representation of search query results
+        limit (int) - number of entries to parse, None for all of them
     Returns:
-        List of Book objects created from first 5 entries
+        List of Book objects created from the first limit entries (5 by
+        default), None if the results have no entries
     """
     if 'items' not in json_results:
         return None
-    json_books = json_results['items'][0:5]
-    return [Book(json_book) for json_book in json_books]
+    json_books = json_results['items'][0:limit]
+    with metrics.timer('parse'):
+        books = Book.from_volumes(json_books)
+    metrics.count('items_parsed', len(books))
+    return books
+
+def iter_result_pages(search_term, page_size=40, cache=None, client=None,
+                      fields=RESULT_FIELDS):
+    """
+    Pages through all results of a search, requesting each page of results
+    only when it is asked for
 
+    Arguments:
+        search_term (str) - string to be searched
+        page_size (int) - results requested per API call (at most 40)
+        cache (ResponseCache) - optional cache consulted before the API
+        client - object with a requests-style get(), defaults to shared client
+        fields (str) - partial response projection
+    Returns:
+        Generator of lists of Book objects, stopping at totalItems
+    Raises:
+        RuntimeError if a request fails
+    """
+    if client is None:
+        client = get_client()
+    start_index = 0
+    more = True
+    while more:
+        books, more = _result_page(search_term, start_index, page_size, cache,
+                                   client, fields)
+        start_index += len(books)
+        yield books
+
+def _result_page(search_term, start_index, page_size, cache, client, fields):
+    # Returns one page of results and whether totalItems says there are more
+    results = query(search_term, cache=cache, client=client, start_index=start_index,
+                    max_results=page_size, fields=fields)
+    if results is None:
+        raise RuntimeError("Invalid request")
+    books = parse_json(results, limit=None) or []
+    more = bool(books) and start_index + len(books) < results.get('totalItems', 0)
+    return books, more
+
+class ResultPager:
+    """
+    Lets the user move back and forth through search results page_size
+    books at a time
+
+    Results are fetched from the API fetch_size at a time, only as far as
+    the user has paged; pages already seen are kept for going back. Once the
+    user is within a page of the end of the fetched results, the next batch
+    is fetched in the background. A batch that fails is requested again the
+    next time it is needed.
+    """
+    def __init__(self, search_term, page_size=5, fetch_size=40, cache=None,
+                 client=None):
+        self.search_term = search_term
+        self.page_size = page_size
+        self.fetch_size = fetch_size
+        self.cache = cache
+        self.client = client if client is not None else get_client()
+        self.page = 0
+        self.books = [] # Every book fetched so far
+        self._more = True # Whether totalItems says there are more to fetch
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._pending = None # Background fetch of the next batch, if any
+
+    @property
+    def first_entry(self):
+        """
+        Index of the first book of the current page among all results
+        """
+        return self.page * self.page_size
+
+    def current_page(self):
+        """
+        Returns:
+            List of Book objects on the current page
+        Raises:
+            RuntimeError if a request fails
+        """
+        return self._page_books(self.page)
+
+    def next_page(self):
+        """
+        Moves to the next page if there is one
+
+        Returns:
+            List of Book objects on the new page, empty if already on the last
+        """
+        books = self._page_books(self.page + 1)
+        if books:
+            self.page += 1
+        return books
+
+    def previous_page(self):
+        """
+        Moves to the previous page if there is one
+
+        Returns:
+            List of Book objects on the new page, empty if already on the first
+        """
+        if self.page == 0:
+            return []
+        self.page -= 1
+        return self.current_page()
+
+    def close(self):
+        """
+        Stops any background fetch without waiting for it to finish
+        """
+        if self._pending is not None:
+            self._pending.cancel()
+        self._executor.shutdown(wait=False)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _page_books(self, page):
+        end = (page + 1) * self.page_size
+        while len(self.books) < end and self._more:
+            self._extend()
+        # Start on the next batch before the user reaches the end of this one
+        if (self._more and self._pending is None
+                and len(self.books) < end + self.page_size):
+            self._pending = self._executor.submit(self._fetch, len(self.books))
+        return self.books[page * self.page_size:end]
+
+    def _fetch(self, start_index):
+        return _result_page(self.search_term, start_index, self.fetch_size,
+                            self.cache, self.client, RESULT_FIELDS)
+
+    def _extend(self):
+        # A failed fetch raises here and leaves _more set, so it is retried
+        if self._pending is not None:
+            pending, self._pending = self._pending, None
+            books, self._more = pending.result()
+        else:
+            books, self._more = self._fetch(len(self.books))
+        self.books.extend(books)
+
+
+class RateLimiter:
+    """
+    Spaces out requests so that at most rate of them start per second
+
+    Thread-safe; each caller reserves the next free slot and waits for it.
+    """
+    def __init__(self, rate, clock=time.monotonic, sleep=time.sleep):
+        self.interval = 1 / rate
+        self.clock = clock
+        self.sleep = sleep
+        self._next = 0
+        self._lock = threading.Lock()
 
-def add_book_to_list(entry_to_add, books, books_in_list, booklist=BOOKLIST):
+    def reserve(self):
+        """
+        Reserves the next request slot
+
+        Returns:
+            Seconds the caller has to wait before making its request
+        """
+        with self._lock:
+            now = self.clock()
+            start = max(now, self._next)
+            self._next = start + self.interval
+            return start - now
+
+    def acquire(self):
+        """
+        Blocks until the caller may make its request
+        """
+        delay = self.reserve()
+        if delay > 0:
+            self.sleep(delay)
+
+@dataclass
+class BatchResult:
+    """
+    Outcome of one search term in a batch:
+        - books found for the term (empty if the search had no results)
+        - error that stopped the search, None on success
+    """
+    term: str
+    books: List[Book]
+    error: Optional[Exception] = None
+
+class _RateLimitedClient:
+    # Waits for a RateLimiter slot before each request; wrapping the client
+    # rather than the search keeps cache hits from using up slots
+    def __init__(self, client, limiter):
+        self.client = client
+        self.limiter = limiter
+
+    def get(self, url, **kwargs):
+        self.limiter.acquire()
+        return self.client.get(url, **kwargs)
+
+def _fetch(term, cache, client):
+    # Searches and parses one term of a batch on a worker, returning any
+    # failure (network, malformed results, cache I/O...) instead of raising
+    # it, so one bad term can't end the whole batch
+    try:
+        results = query(term, cache=cache, client=client)
+        if results is None:
+            return None, RuntimeError("Invalid request")
+        return parse_json(results) or [], None
+    except Exception as e:
+        return None, e
+
+def _batch_result(term, books, error):
+    # Terms sharing a search each get their own list
+    return BatchResult(term, None if books is None else list(books), error)
+
+def query_many(terms, max_workers=8, rate=None, cache=None, client=None):
+    """
+    Searches for many terms concurrently on a thread pool
+
+    Identical terms (after normalization) that are in flight at the same time
+    share a single request.
+
+    Arguments:
+        terms (iterable of str) - strings to be searched
+        max_workers (int) - maximum number of concurrent requests
+        rate (float) - maximum requests started per second, None for no limit
+        cache (ResponseCache) - optional cache consulted before the API
+        client - object with a requests-style get(), defaults to shared client
+    Returns:
+        Generator of BatchResult, in order of completion
+    """
+    if client is None:
+        client = get_client()
+    if rate:
+        client = _RateLimitedClient(client, RateLimiter(rate))
+
+    terms = iter(terms)
+    in_flight = {} # future -> key of the term it is searching
+    waiting = {}   # key -> terms sharing that search
+    exhausted = False
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while True:
+            # Keep a bounded window of submitted searches
+            while not exhausted and len(in_flight) < max_workers * 2:
+                term = next(terms, None)
+                if term is None:
+                    exhausted = True
+                    break
+                key = ResponseCache.make_key(term)
+                if key in waiting:
+                    waiting[key].append(term)
+                    continue
+                waiting[key] = [term]
+                in_flight[executor.submit(_fetch, term, cache, client)] = key
+            if not in_flight:
+                return
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                books, error = future.result()
+                for term in waiting.pop(in_flight.pop(future)):
+                    yield _batch_result(term, books, error)
+
+async def query_many_async(terms, max_concurrency=8, rate=None, cache=None,
+                           client=None):
+    """
+    Searches for many terms concurrently from an asyncio event loop
+
+    Requests run on a dedicated pool of max_concurrency threads, with a
+    bounded window of searches submitted at a time; identical terms in flight
+    at the same time share a single request. Searches still pending when the
+    generator is closed are cancelled.
+
+    Arguments:
+        terms (iterable of str) - strings to be searched
+        max_concurrency (int) - maximum number of concurrent requests
+        rate (float) - maximum requests started per second, None for no limit
+        cache (ResponseCache) - optional cache consulted before the API
+        client - object with a requests-style get(), defaults to shared client
+    Returns:
+        Async generator of BatchResult, in order of completion
+    """
+    if client is None:
+        client = get_client()
+    if rate:
+        client = _RateLimitedClient(client, RateLimiter(rate))
+    loop = asyncio.get_running_loop()
+    executor = ThreadPoolExecutor(max_workers=max_concurrency)
+
+    terms = iter(terms)
+    in_flight = {} # future -> key of the term it is searching
+    waiting = {}   # key -> terms sharing that search
+    exhausted = False
+    try:
+        while True:
+            # Keep a bounded window of submitted searches
+            while not exhausted and len(in_flight) < max_concurrency * 2:
+                term = next(terms, None)
+                if term is None:
+                    exhausted = True
+                    break
+                key = ResponseCache.make_key(term)
+                if key in waiting:
+                    waiting[key].append(term)
+                    continue
+                waiting[key] = [term]
+                future = loop.run_in_executor(executor, _fetch, term, cache, client)
+                in_flight[future] = key
+            if not in_flight:
+                return
+            done, _ = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+            for future in done:
+                books, error = future.result()
+                for term in waiting.pop(in_flight.pop(future)):
+                    yield _batch_result(term, books, error)
+    finally:
+        # Cancelling the asyncio futures cancels the queued executor jobs
+        for future in in_flight:
+            future.cancel()
+        executor.shutdown(wait=False)
+
+BOOKLIST_SCHEMA = """
+CREATE TABLE IF NOT EXISTS books (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT, -- order books were added in
+    id TEXT UNIQUE,                        -- NULL for migrated text entries
+    isbn_10 TEXT,
+    isbn_13 TEXT,
+    title TEXT NOT NULL,
+    authors TEXT NOT NULL,                 -- JSON list
+    publisher TEXT NOT NULL,
+    published_date TEXT,
+    page_count INTEGER
+);
+CREATE INDEX IF NOT EXISTS books_isbn_13 ON books(isbn_13);
+CREATE INDEX IF NOT EXISTS books_title ON books(title);
+CREATE INDEX IF NOT EXISTS books_publisher ON books(publisher);
+-- Lets sorting by (first) author read the index instead of sorting the list
+CREATE INDEX IF NOT EXISTS books_first_author ON books(json_extract(authors, '$[0]'));
+CREATE TABLE IF NOT EXISTS book_authors (
+    book INTEGER NOT NULL REFERENCES books(seq),
+    author TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS book_authors_author ON book_authors(author);
+"""
+
+class BookStore:
+    """
+    Reading list stored in SQLite
+
+    Books are keyed by Google volume id (falling back to ISBN-13), so
+    duplicate checks and lookups by title, author or publisher use indexes
+    instead of reading the whole list.
+
+    Several sessions can share a booklist: each add is one transaction that
+    holds the write lock from its duplicate check to its commit, and
+    duplicate checks always read the file, so nothing goes stale when
+    another session adds books.
+    """
+    def __init__(self, path=BOOKLIST, timeout=30):
+        self.path = path
+        # Autocommit mode; writes go through _transaction() instead
+        self.conn = sqlite3.connect(path, timeout=timeout, isolation_level=None)
+        # With a write-ahead log readers don't block the writer, and a crash
+        # can only lose whole transactions
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(BOOKLIST_SCHEMA)
+        # Booklists created before these columns existed
+        with self._transaction():
+            columns = {row[1] for row in self.conn.execute("PRAGMA table_info(books)")}
+            for column, column_type in (('published_date', 'TEXT'), ('page_count', 'INTEGER')):
+                if column not in columns:
+                    self.conn.execute("ALTER TABLE books ADD COLUMN {} {}".format(
+                        column, column_type))
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM books").fetchone()[0]
+
+    # Same order as Book's fields
+    BOOK_COLUMNS = ("title, authors, publisher, id, isbn_10, isbn_13, "
+                    "published_date, page_count")
+    SORT_COLUMNS = {'title': "title",
+                    'author': "json_extract(authors, '$[0]')",
+                    'publisher': "publisher"}
+
+    def __iter__(self):
+        """
+        Yields books in the order they were added, without loading them all
+        """
+        return self.iter_books()
+
+    def iter_books(self, filters=None, sort=None, limit=None, offset=0, page_size=100):
+        """
+        Streams books from the list, reading page_size rows at a time
+
+        Sorting uses an index, so the first books are available without
+        reading (or sorting) the rest of the list.
+
+        Arguments:
+            filters (dict(str)) - title/author/publisher substrings to match
+            sort (str) - 'title', 'author' or 'publisher', None for added order
+            limit (int) - maximum number of books, None for all
+            offset (int) - number of matching books to skip
+            page_size (int) - rows fetched from the database at a time
+        Returns:
+            Generator of Book objects
+        """
+        sql = "SELECT " + self.BOOK_COLUMNS + " FROM books"
+        where, params = [], []
+        for field_name, value in (filters or {}).items():
+            pattern = '%' + re.sub(r'([\\%_])', r'\\\1', value) + '%'
+            if field_name == 'author':
+                where.append("seq IN (SELECT book FROM book_authors "
+                             "WHERE author LIKE ? ESCAPE '\\')")
+            elif field_name in ('title', 'publisher'):
+                where.append(field_name + " LIKE ? ESCAPE '\\'")
+            else:
+                raise ValueError("Cannot filter on " + field_name)
+            params.append(pattern)
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        if sort is None:
+            sql += " ORDER BY seq"
+        else:
+            sql += " ORDER BY {}, seq".format(self.SORT_COLUMNS[sort])
+        sql += " LIMIT ? OFFSET ?"
+        params += [-1 if limit is None else limit, offset]
+        cursor = self.conn.execute(sql, params)
+        while True:
+            rows = cursor.fetchmany(page_size)
+            if not rows:
+                return
+            for row in rows:
+                yield self._to_book(row)
+
+    def __contains__(self, book):
+        """
+        Checks whether book is already in the list
+
+        Matches on volume id or ISBN-13; books migrated from the text booklist
+        have neither, so they are matched on title.
+        """
+        if book.id is not None and self.conn.execute(
+                "SELECT 1 FROM books WHERE id = ?", (book.id,)).fetchone():
+            return True
+        if book.isbn_13 is not None and self.conn.execute(
+                "SELECT 1 FROM books WHERE isbn_13 = ?", (book.isbn_13,)).fetchone():
+            return True
+        return self.conn.execute(
+            "SELECT 1 FROM books WHERE title = ? AND id IS NULL",
+            (book.title,)).fetchone() is not None
+
+    def add(self, book):
+        """
+        Adds a book to the list unless it is already there
+
+        Returns:
+            True if the book was added, False if it was a duplicate
+        """
+        with metrics.timer('booklist_write'):
+            with self._transaction():
+                size = self._insert(book)
+        return self._count_added([size]) == 1
+
+    def add_many(self, books):
+        """
+        Adds several books in a single transaction, skipping duplicates
+
+        Much faster than add() for bulk imports, since the whole batch is
+        written to disk at once.
+
+        Returns:
+            Number of books added
+        """
+        with metrics.timer('booklist_write'):
+            with self._transaction():
+                sizes = [self._insert(book) for book in books]
+        return self._count_added(sizes)
+
+    def find(self, title=None, author=None, publisher=None):
+        """
+        Looks up books by exact title, author and/or publisher
+
+        Returns:
+            List of matching books, in the order they were added
+        """
+        sql = "SELECT " + self.BOOK_COLUMNS + " FROM books"
+        where, params = [], []
+        if title is not None:
+            where.append("title = ?")
+            params.append(title)
+        if author is not None:
+            where.append("seq IN (SELECT book FROM book_authors WHERE author = ?)")
+            params.append(author)
+        if publisher is not None:
+            where.append("publisher = ?")
+            params.append(publisher)
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        cursor = self.conn.execute(sql + " ORDER BY seq", params)
+        return [self._to_book(row) for row in cursor]
+
+    @contextmanager
+    def _transaction(self):
+        # IMMEDIATE takes the write lock up front, so another session can't
+        # add the same book between our duplicate check and our insert
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+        self.conn.execute("COMMIT")
+
+    def _insert(self, book):
+        # Returns the record's size for metrics, or None for a duplicate
+        if book in self:
+            return None
+        row = (book.title, json.dumps(book.authors), book.publisher, book.id,
+               book.isbn_10, book.isbn_13, book.published_date, book.page_count)
+        cursor = self.conn.execute(
+            "INSERT INTO books (" + self.BOOK_COLUMNS + ") VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            row)
+        self.conn.executemany(
+            "INSERT INTO book_authors (book, author) VALUES (?, ?)",
+            [(cursor.lastrowid, author) for author in book.authors])
+        if not metrics.enabled:
+            return 0
+        # Size of the record's values, not counting SQLite's own overhead
+        return sum(len(str(value).encode('utf-8'))
+                   for value in row + tuple(book.authors) if value is not None)
+
+    @staticmethod
+    def _count_added(sizes):
+        # Only called once the transaction committed, so rolled back
+        # inserts are never counted
+        added = [size for size in sizes if size is not None]
+        if added:
+            metrics.count('books_added', len(added))
+            metrics.count('booklist_bytes_written', sum(added))
+        return len(added)
+
+    @staticmethod
+    def _to_book(row):
+        title, authors, publisher, *rest = row
+        return Book(title, list(map(sys.intern, json.loads(authors))),
+                    sys.intern(publisher), *rest)
+
+def read_text_booklist(path):
+    """
+    Reads books from the old plain text booklist format
+
+    Arguments:
+        path (str) - text booklist written by earlier versions
+    Returns:
+        Generator of Book objects (without id or ISBNs)
+    """
+    title = authors = None
+    with open(path, 'r') as f:
+        for line in f:
+            line = line.rstrip('\n')
+            if line.startswith("Title: ") and authors is None and title is None:
+                title = line[len("Title: "):]
+            elif line.startswith("Authors: ") and title is not None:
+                authors = line[len("Authors: "):].split(', ')
+            elif line.startswith("Publisher: ") and authors is not None:
+                yield Book(title, authors, line[len("Publisher: "):])
+                title = authors = None
+            elif title is not None and authors is None:
+                # Titles containing newlines span several lines
+                title += '\n' + line
+
+def open_booklist(path=BOOKLIST, legacy_path=LEGACY_BOOKLIST):
+    """
+    Opens the booklist, migrating the old text booklist on first use
+
+    Arguments:
+        path (str) - SQLite booklist
+        legacy_path (str) - text booklist written by earlier versions
+    Returns:
+        BookStore
+    Side Effects:
+        Renames a migrated text booklist to <legacy_path>.migrated
+    """
+    with metrics.timer('booklist_open'):
+        store = BookStore(path)
+    if os.path.isfile(legacy_path):
+        try:
+            store.add_many(read_text_booklist(legacy_path))
+            os.replace(legacy_path, legacy_path + '.migrated')
+        except FileNotFoundError:
+            pass # Another session migrated it first
+    return store
+
+def add_book_to_list(entry_to_add, books, store):
     """
     Adds a book to the reading list
 
     Arguments:
         entry_to_add (int) - index of the book the user wants to add to list
         books (List[Book]) - list of possible books to add
-        books_in_list (dict(str)) - set containing titles of books in booklist
+        store (BookStore) - reading list
     Returns:
         Nothing
     Side Effects: 
@@ -79,40 +1375,57 @@ def add_book_to_list(entry_to_add, books, books_in_list, booklist=BOOKLIST):
         Prints error message if invalid index is provided
     """
     if entry_to_add in range(len(books)):
-        new_book = books[entry_to_add]
-        if new_book.title not in books_in_list:
-            with open(booklist, 'a+') as f:
-                f.write(str(books[entry_to_add]))
-            books_in_list.add(new_book.title)
-        else:
+        if not store.add(books[entry_to_add]):
             print("Book already in list")
     else:
         print("Invalid index")
 
-def view_list(booklist=BOOKLIST):
+def view_list(store, filters=None, sort=None, limit=None, offset=0,
+              page_size=20, more=None):
     """
-    Prints out current reading list to user
+    Prints out current reading list to user, a page at a time
 
+    Arguments:
+        store (BookStore) - reading list
+        filters (dict(str)) - title/author/publisher substrings to match
+        sort (str) - 'title', 'author' or 'publisher', None for added order
+        limit (int) - maximum number of books to show, None for all
+        offset (int) - number of matching books to skip
+        page_size (int) - number of books per page
+        more (callable) - called after each full page, stops if it returns False
     Returns:
         Nothing
     Side Effects:
         Displays reading list to console
     """
-    if not os.path.isfile(booklist):
-        print("Booklist not yet created, please add a book through query")
-    else:
-        print() # For better formatting/readability of output
-        print("=" * 50)
-        print("Booklist: \n")
-        with open(booklist, 'r') as f:
-            lines = f.readlines()
-        print(''.join(lines))
-        print("=" * 50)
+    books = store.iter_books(filters, sort, limit, offset, page_size)
+    book = next(books, None)
+    if book is None:
+        if len(store) == 0:
+            print("Booklist not yet created, please add a book through query")
+        else:
+            print("No books in booklist match")
+        return
+    print() # For better formatting/readability of output
+    print("=" * 50)
+    print("Booklist: \n")
+    shown = 0
+    while book is not None:
+        print(str(book), end='')
+        shown += 1
+        book = next(books, None)
+        if book is not None and shown % page_size == 0 and more and not more():
+            break
+    print()
+    print("=" * 50)
 
-def view_query_results(books):
+def view_query_results(books, first_entry=0):
     """
     Prints out query results to user
 
+    Arguments:
+        books (List[Book]) - books to display
+        first_entry (int) - position of books[0] among all results
     Returns:
         Nothing
     Side Effects:
@@ -122,57 +1435,151 @@ def view_query_results(books):
     print("-" * 50)
     print("Query Results: \n")
     for i in range(len(books)):
-        print("Entry #{}".format(i+1))
+        print("Entry #{}".format(first_entry+i+1))
         print(str(books[i]))
     print("-" * 50)
 
-def populate_books_in_list(books_in_list):
+def run_batch(path, store, max_workers=8, rate=10, cache=None, client=None,
+              flush_size=500):
     """
-    Adds books in booklist to a set to prevent duplicate entries
+    Imports a reading list, adding the top result for each term to the booklist
 
     Arguments:
-        books_in_list (dict(str)) - set containing titles of books in booklist
+        path (str) - file with one search term (title, ISBN, ...) per line
+        store (BookStore) - reading list
+        max_workers (int) - maximum number of concurrent requests
+        rate (float) - maximum requests started per second
+        flush_size (int) - number of found books written per transaction
     Returns:
-        None
+        Number of terms that failed
     Side Effects:
-        Populates set with books in the booklist
-    """
-    if os.path.isfile(BOOKLIST):
-        with open(BOOKLIST, 'r') as f:
-            lines = f.readlines()
-        for i in range(len(lines)):
-            if i % 4 == 0:
-                title = lines[i][7:]
-                books_in_list.add(title.strip())
-    
+        Reading list has the found books added
+        Prints the outcome of each term
+    """
+    with open(path, 'r') as f:
+        terms = [line.strip() for line in f if line.strip()]
+    failures = 0
+    added = 0
+    pending = [] # Found books not yet written to the booklist
+    try:
+        for result in query_many(terms, max_workers=max_workers, rate=rate,
+                                 cache=cache, client=client):
+            if result.error is not None:
+                failures += 1
+                print("{}: failed ({})".format(result.term, result.error))
+            elif not result.books:
+                print("{}: no results".format(result.term))
+            else:
+                print("{}: {}".format(result.term, result.books[0].title))
+                pending.append(result.books[0])
+                if len(pending) >= flush_size:
+                    added += store.add_many(pending)
+                    pending = []
+    finally:
+        # Keep what was found even if the import is interrupted
+        added += store.add_many(pending)
+    print("Searched {} terms, {} failed, {} books added".format(
+        len(terms), failures, added))
+    return failures
+
+def _non_negative_int(text):
+    # argparse type for --limit/--offset
+    if not text.isdigit():
+        raise argparse.ArgumentTypeError("expected a non-negative integer: {}".format(text))
+    return int(text)
 
 if __name__ == '__main__':
-    books_in_list = set() # Used to prevent duplicate entries
-    populate_books_in_list(books_in_list)
+    parser = argparse.ArgumentParser(description="Search Google Books and keep a reading list")
+    parser.add_argument('--batch', metavar='FILE',
+                        help="add the top result for each search term in FILE and exit")
+    parser.add_argument('--view', action='store_true',
+                        help="print the booklist and exit")
+    parser.add_argument('--filter', metavar='FIELD=TEXT', action='append', default=[],
+                        help="with --view, only show books whose title, author or "
+                             "publisher contains TEXT (repeatable)")
+    parser.add_argument('--sort', choices=sorted(BookStore.SORT_COLUMNS),
+                        help="with --view, sort the booklist")
+    parser.add_argument('--limit', type=_non_negative_int,
+                        help="with --view, show at most LIMIT books")
+    parser.add_argument('--offset', type=_non_negative_int, default=0,
+                        help="with --view, skip the first OFFSET books")
+    parser.add_argument('--workers', type=int, default=8,
+                        help="concurrent requests in batch mode (default: 8)")
+    parser.add_argument('--rate', type=float, default=10,
+                        help="maximum requests per second in batch mode (default: 10)")
+    parser.add_argument('--profile', action='store_true',
+                        help="profile the session and print a report on exit")
+    parser.add_argument('--metrics', metavar='FILE',
+                        help="export per-stage timings and counters to FILE on exit "
+                             "(Prometheus text if FILE ends in .prom, else JSON lines)")
+    args = parser.parse_args()
+    if args.profile or args.metrics:
+        enable_instrumentation(args.profile, args.metrics)
+    filters = {}
+    for view_filter in args.filter:
+        field_name, _, value = view_filter.partition('=')
+        if field_name not in ('title', 'author', 'publisher') or not value:
+            parser.error("--filter must look like title=..., author=... or publisher=...")
+        filters[field_name] = value
+
+    store = open_booklist()
+    cache = ResponseCache(directory=CACHE_DIR)
+
+    if args.batch:
+        failures = run_batch(args.batch, store, max_workers=args.workers,
+                             rate=args.rate, cache=cache)
+        raise SystemExit(1 if failures else 0)
+    if args.view:
+        view_list(store, filters, args.sort, args.limit, args.offset, page_size=100)
+        raise SystemExit(0)
 
     while(True):
         # Presents user with choice of viewing booklist or making a query
         response = input("Would you like to (v)iew your booklist or make a (s)earch? ").lower()
         if response == "v" or response == "view":
-            view_list() 
+            view_list(store, more=lambda: input(
+                "Press ENTER for more or (q)uit: ").lower() not in ("q", "quit"))
         elif response == "s" or response == "search":
             search_term = input("Please input your search term: ")
-            books = query(search_term)
-            # Make sure query is successful
-            if not books:
-                print("Invalid request")
-                break
-            # Make sure query has books to parse
-            books = parse_json(books)
-            if not books:
-                print("Search yielded no results")
-                continue
-            view_query_results(books)
-            # Lets user add one of the results from the query to their booklist
-            entry_to_add = input("Which entry would you like to add? (Press ENTER to skip): ")
-            if entry_to_add.isdigit(): # Makes sure digit before casting to int
-                entry_to_add = int(entry_to_add) - 1 # account for proper index 
-                add_book_to_list(entry_to_add, books, books_in_list)
+            with ResultPager(search_term, cache=cache) as pager:
+                # Make sure query is successful
+                try:
+                    books = pager.current_page()
+                # Network errors and timeouts shouldn't end the session either
+                except (RuntimeError, requests.RequestException):
+                    print("Invalid request")
+                    continue
+                # Make sure query has books to parse
+                if not books:
+                    print("Search yielded no results")
+                    continue
+                view_query_results(books, pager.first_entry)
+                # Lets user page through results and add one of them to their booklist
+                while True:
+                    entry_to_add = input("Which entry would you like to add? "
+                                         "((n)ext/(p)revious page, ENTER to skip): ").lower()
+                    if entry_to_add in ("n", "next", "p", "previous"):
+                        try:
+                            if entry_to_add.startswith("n"):
+                                new_page = pager.next_page()
+                            else:
+                                new_page = pager.previous_page()
+                        except (RuntimeError, requests.RequestException):
+                            print("Invalid request")
+                            continue
+                        if new_page:
+                            books = new_page
+                            view_query_results(books, pager.first_entry)
+                        elif entry_to_add.startswith("n"):
+                            print("No more results")
+                        else:
+                            print("Already on first page")
+                        continue
+                    if entry_to_add.isdigit(): # Makes sure digit before casting to int
+                        # account for proper index within the current page
+                        entry_to_add = int(entry_to_add) - 1 - pager.first_entry
+                        add_book_to_list(entry_to_add, books, store)
+                    break
         # If input anything other than v/q exit program
         else:
             break
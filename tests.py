@@ -1,9 +1,52 @@
+import asyncio
+import gzip
+import json
 import os
 import pytest
+import sqlite3
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from google_booklist import *
 from saved_queries import *
+import benchmarks
 
-TEST_BOOKLIST = 'my_test_booklist.txt'
+TEST_BOOKLIST = 'my_test_booklist.db'
+
+# Stand-in for requests' response/transport so tests can run offline
+class StubResponse:
+    def __init__(self, status_code, payload=None, headers=None):
+        self.status_code = status_code
+        self.payload = payload
+        self.headers = headers or {}
+
+    def json(self):
+        return self.payload
+
+    @property
+    def content(self):
+        return json.dumps(self.payload).encode('utf-8')
+
+class StubClient:
+    def __init__(self, payloads, etag=None):
+        self.payloads = payloads
+        self.etag = etag
+        self.calls = []
+
+    def get(self, url, params=None, headers=None, **kwargs):
+        self.calls.append((params, dict(headers or {})))
+        if headers and headers.get('If-None-Match') == self.etag:
+            return StubResponse(304)
+        if params['q'] not in self.payloads:
+            return StubResponse(400)
+        return StubResponse(200, self.payloads[params['q']], {'ETag': self.etag})
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
 
 # Tests query() function
 class TestQuery:
@@ -48,24 +91,734 @@ class TestParseJSON:
                 'Title: The Fellowship of the Ring\nAuthors: Unknown\n' + 
                 'Publisher: HarperCollins Publishers\n\n')
 
+# Local stand-in for the Google Books API
+class LocalBooksHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # Allows keep-alive connections
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+
+    def do_GET(self):
+        self.server.requests.append(dict(self.headers))
+        status, headers = (self.server.script.pop(0) if self.server.script
+                           else (200, {}))
+        body = json.dumps(mistborn_query).encode('utf-8')
+        if status == 200 and 'gzip' in self.headers.get('Accept-Encoding', ''):
+            body = gzip.compress(body)
+            headers = dict(headers, **{'Content-Encoding': 'gzip'})
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def local_server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), LocalBooksHandler)
+    server.connections = 0
+    server.requests = []
+    server.script = [] # (status, headers) to answer with before plain 200s
+    server.url = 'http://127.0.0.1:{}/books/v1/volumes'.format(server.server_port)
+    thread = threading.Thread(target=server.serve_forever, args=(0.05,), daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+# Tests BooksClient against a local server
+class TestBooksClient:
+    def test_connections_reused(self, local_server):
+        with BooksClient() as client:
+            for _ in range(3):
+                assert client.get(local_server.url, params={'q': 'mistborn'}).json()
+        assert local_server.connections == 1
+
+    def test_gzip_negotiated(self, local_server):
+        with BooksClient() as client:
+            response = client.get(local_server.url, params={'q': 'mistborn'})
+        assert 'gzip' in local_server.requests[0]['Accept-Encoding']
+        assert response.headers['Content-Encoding'] == 'gzip'
+        assert response.json() == mistborn_query
+
+    def test_retries_with_backoff(self, local_server):
+        local_server.script = [(503, {}), (429, {})]
+        delays = []
+        with BooksClient(backoff=1, sleep=delays.append) as client:
+            response = client.get(local_server.url, params={'q': 'mistborn'})
+        assert response.status_code == 200
+        assert len(delays) == 2
+        assert 0 <= delays[0] <= 1 and 0 <= delays[1] <= 2
+
+    def test_honors_retry_after(self, local_server):
+        local_server.script = [(429, {'Retry-After': '7'})]
+        delays = []
+        with BooksClient(sleep=delays.append) as client:
+            client.get(local_server.url, params={'q': 'mistborn'})
+        assert delays == [7]
+
+    def test_gives_up_after_max_retries(self, local_server):
+        local_server.script = [(503, {})] * 3
+        with BooksClient(max_retries=2, sleep=lambda delay: None) as client:
+            response = client.get(local_server.url, params={'q': 'mistborn'})
+        assert response.status_code == 503
+        assert len(local_server.requests) == 3
+
+# Tests ResponseCache in front of query()
+class TestResponseCache:
+    def test_repeated_query_served_from_cache(self):
+        client = StubClient({'mistborn': mistborn_query})
+        cache = ResponseCache()
+        first = query('mistborn', cache=cache, client=client)
+        second = query('  Mistborn ', cache=cache, client=client)
+        assert first == second == mistborn_query
+        assert len(client.calls) == 1
+        assert cache.stats()['hits'] == 1 and cache.stats()['misses'] == 1
+
+    def test_failed_query_not_cached(self):
+        client = StubClient({})
+        cache = ResponseCache()
+        assert query('', cache=cache, client=client) is None
+        assert query('', cache=cache, client=client) is None
+        assert len(client.calls) == 2
+
+    def test_lru_eviction(self):
+        client = StubClient({'mistborn': mistborn_query, 'lotr': lotr_query,
+                             'barbarian': barbarian_query})
+        cache = ResponseCache(max_entries=2)
+        for term in ('mistborn', 'lotr', 'mistborn', 'barbarian'):
+            query(term, cache=cache, client=client)
+        assert cache.get(cache.make_key('mistborn')) == mistborn_query
+        assert cache.get(cache.make_key('lotr')) is None
+
+    def test_stale_entry_revalidated_with_etag(self):
+        clock = FakeClock()
+        client = StubClient({'mistborn': mistborn_query}, etag='"abc"')
+        cache = ResponseCache(ttl=60, clock=clock)
+        query('mistborn', cache=cache, client=client)
+        clock.now += 61
+        assert query('mistborn', cache=cache, client=client) == mistborn_query
+        assert client.calls[-1][1] == {'If-None-Match': '"abc"'}
+        assert cache.stats()['revalidations'] == 1
+        # Revalidation refreshes the entry so the next lookup is a plain hit
+        query('mistborn', cache=cache, client=client)
+        assert len(client.calls) == 2
+
+    def test_disk_cache_survives_new_instance(self, tmp_path):
+        client = StubClient({'barbarian': barbarian_query})
+        query('barbarian', cache=ResponseCache(directory=str(tmp_path)), client=client)
+        cache = ResponseCache(directory=str(tmp_path))
+        assert query('barbarian', cache=cache, client=client) == barbarian_query
+        assert len(client.calls) == 1
+
+    def test_unreadable_disk_entry_is_miss(self, tmp_path):
+        client = StubClient({'barbarian': barbarian_query})
+        query('barbarian', cache=ResponseCache(directory=str(tmp_path)), client=client)
+        for name in os.listdir(str(tmp_path)):
+            with open(str(tmp_path / name), 'w') as f:
+                f.write('{"key": ')
+        cache = ResponseCache(directory=str(tmp_path))
+        assert query('barbarian', cache=cache, client=client) == barbarian_query
+        assert query('barbarian', cache=ResponseCache(directory=str(tmp_path)),
+                     client=client) == barbarian_query
+        assert len(client.calls) == 2
+
+    def test_no_temp_files_left(self, tmp_path):
+        client = StubClient({'barbarian': barbarian_query})
+        query('barbarian', cache=ResponseCache(directory=str(tmp_path)), client=client)
+        assert [name[-5:] for name in os.listdir(str(tmp_path))] == ['.json']
+
+    def test_eviction_tolerates_files_removed_by_others(self, tmp_path, monkeypatch):
+        client = StubClient({'mistborn': mistborn_query, 'lotr': lotr_query})
+        cache = ResponseCache(directory=str(tmp_path), max_disk_entries=1)
+        query('mistborn', cache=cache, client=client)
+
+        def already_removed(path):
+            raise FileNotFoundError(path)
+        monkeypatch.setattr(os, 'remove', already_removed)
+        assert query('lotr', cache=cache, client=client) == lotr_query
+
+    def test_failed_disk_write_falls_back_to_memory(self, tmp_path):
+        client = StubClient({'barbarian': barbarian_query})
+        directory = tmp_path / 'cache'
+        cache = ResponseCache(directory=str(directory))
+        directory.rmdir() # e.g. cleaned up by another session
+        assert query('barbarian', cache=cache, client=client) == barbarian_query
+        assert cache.directory is None
+        assert query('barbarian', cache=cache, client=client) == barbarian_query
+        assert len(client.calls) == 1
+
+    def test_full_disk_cache_not_rescanned_every_put(self, tmp_path, monkeypatch):
+        cache = ResponseCache(directory=str(tmp_path), max_disk_entries=100)
+        scans = []
+        scandir = os.scandir
+        monkeypatch.setattr(os, 'scandir', lambda path: scans.append(path) or scandir(path))
+        for i in range(200):
+            cache.put(ResponseCache.make_key('term {}'.format(i)), {'totalItems': i})
+        assert len(scans) <= 12
+        assert len(os.listdir(str(tmp_path))) <= 100
+
+    def test_revalidation_after_stale_entry_evicted(self):
+        clock = FakeClock()
+        cache = ResponseCache(max_entries=1, ttl=60, clock=clock)
+
+        class EvictingClient(StubClient):
+            # Another worker fills the cache while this request is in flight
+            def get(self, url, params=None, headers=None, **kwargs):
+                cache.put(cache.make_key('other'), {})
+                return super().get(url, params=params, headers=headers, **kwargs)
+        client = EvictingClient({'mistborn': mistborn_query}, etag='"abc"')
+        cache.put(cache.make_key('mistborn'), mistborn_query, '"abc"')
+        clock.now += 61
+        assert query('mistborn', cache=cache, client=client) == mistborn_query
+        assert client.calls[-1][1] == {'If-None-Match': '"abc"'}
+        assert cache.stats()['revalidations'] == 1
+
+    def test_disk_cache_bounded(self, tmp_path):
+        client = StubClient({'mistborn': mistborn_query, 'lotr': lotr_query,
+                             'barbarian': barbarian_query})
+        cache = ResponseCache(directory=str(tmp_path), max_disk_entries=2)
+        for term in ('mistborn', 'lotr', 'barbarian'):
+            query(term, cache=cache, client=client)
+        assert len(os.listdir(str(tmp_path))) == 2
+
+class SlowClient(StubClient):
+    # Tracks how many requests are in flight at once
+    def __init__(self, payloads):
+        super().__init__(payloads)
+        self.active = 0
+        self.max_active = 0
+        self.lock = threading.Lock()
+
+    def get(self, url, params=None, headers=None, **kwargs):
+        with self.lock:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        time.sleep(0.01)
+        with self.lock:
+            self.active -= 1
+        return super().get(url, params=params, headers=headers, **kwargs)
+
+# Tests query_many() and query_many_async()
+class TestQueryMany:
+    payloads = {'mistborn': mistborn_query, 'barbarian': barbarian_query,
+                'nothing': {'kind': 'books#volumes', 'totalItems': 0}}
+
+    def test_results_for_every_term(self):
+        client = StubClient(self.payloads)
+        results = {r.term: r for r in query_many(['mistborn', 'barbarian'], client=client)}
+        assert results['mistborn'].books[0].title == 'Mistborn'
+        assert results['barbarian'].books[0].title == 'Barbarian Days'
+
+    def test_duplicate_terms_share_request(self):
+        client = StubClient(self.payloads)
+        results = list(query_many(['mistborn', ' Mistborn', 'barbarian'], client=client))
+        assert sorted(r.term for r in results) == [' Mistborn', 'barbarian', 'mistborn']
+        assert len(client.calls) == 2
+
+    def test_failures_reported_per_term(self):
+        client = StubClient(self.payloads)
+        results = {r.term: r for r in query_many(['missing', 'nothing', 'mistborn'],
+                                                 client=client)}
+        assert results['missing'].books is None and results['missing'].error
+        assert results['nothing'].books == [] and results['nothing'].error is None
+        assert results['mistborn'].error is None
+
+    def test_malformed_results_reported_per_term(self, tmp_path):
+        client = StubClient(dict(self.payloads, broken={'items': [{'id': 'x'}]}))
+        terms = tmp_path / 'terms.txt'
+        terms.write_text('mistborn\nbroken\nbarbarian\n')
+        with BookStore(str(tmp_path / 'booklist.db')) as store:
+            assert run_batch(str(terms), store, rate=None, client=client) == 1
+            assert len(store) == 2
+        results = {r.term: r for r in query_many(['broken', 'mistborn'], client=client)}
+        assert isinstance(results['broken'].error, KeyError)
+        assert results['mistborn'].books[0].title == 'Mistborn'
+
+    def test_concurrency_bounded(self):
+        client = SlowClient(self.payloads)
+        terms = ['mistborn {}'.format(i) for i in range(20)]
+        client.payloads.update({term: mistborn_query for term in terms})
+        assert len(list(query_many(terms, max_workers=3, client=client))) == 20
+        assert 1 < client.max_active <= 3
+
+    def test_async_variant(self):
+        client = StubClient(self.payloads)
+
+        async def collect():
+            return [r async for r in query_many_async(
+                ['mistborn', 'MISTBORN', 'missing'], max_concurrency=2, client=client)]
+        results = {r.term: r for r in asyncio.run(collect())}
+        assert results['MISTBORN'].books[0].title == 'Mistborn'
+        assert results['missing'].error
+        assert len(client.calls) == 2
+
+    def test_async_window_bounded_and_cancelled(self):
+        client = SlowClient(self.payloads)
+        terms = ('mistborn {}'.format(i) for i in range(1000))
+
+        async def first_result():
+            results = query_many_async(terms, max_concurrency=2, client=client)
+            result = await results.__anext__()
+            await results.aclose()
+            return result
+        assert asyncio.run(first_result())
+        assert client.max_active <= 2
+        assert len(client.calls) <= 4 # The rest of the window was cancelled
+        assert len(list(terms)) >= 990
+
+    def test_cache_hits_skip_rate_limit(self):
+        client = StubClient(self.payloads)
+        cache = ResponseCache()
+        query('mistborn', cache=cache, client=client)
+        start = time.perf_counter()
+        results = list(query_many(['mistborn'] * 3 + ['barbarian'], rate=1,
+                                  cache=cache, client=client))
+        assert len(results) == 4
+        assert time.perf_counter() - start < 0.5
+        assert len(client.calls) == 2
+
+    def test_rate_limiter_spaces_requests(self):
+        clock = FakeClock()
+        limiter = RateLimiter(2, clock=clock)
+        assert [limiter.reserve() for _ in range(3)] == [0, 0.5, 1.0]
+        clock.now += 5
+        assert limiter.reserve() == 0
+
+    def test_run_batch_adds_top_results(self, tmp_path):
+        terms = tmp_path / 'terms.txt'
+        terms.write_text('mistborn\n\nbarbarian\nmissing\n')
+        with BookStore(str(tmp_path / 'booklist.db')) as store:
+            failures = run_batch(str(terms), store, rate=None,
+                                 client=StubClient(self.payloads))
+            assert failures == 1
+            assert sorted(book.title for book in store) == ['Barbarian Days', 'Mistborn']
+
+class PagedClient:
+    # Serves total synthetic volumes, honoring startIndex/maxResults
+    def __init__(self, total):
+        self.total = total
+        self.calls = []
+        self.requested = {} # startIndex -> Event set when it is requested
+        self.gate = None # Event later pages wait for, if set
+        self.failures = set() # startIndexes answered with a 503 once
+
+    def get(self, url, params=None, headers=None, **kwargs):
+        self.calls.append(params)
+        start = params.get('startIndex', 0)
+        self.request_event(start).set()
+        if start in self.failures:
+            self.failures.remove(start)
+            return StubResponse(503)
+        if start and self.gate is not None:
+            self.gate.wait()
+        end = min(start + params.get('maxResults', 10), self.total)
+        items = [{'id': str(i), 'volumeInfo': {'title': 'Book {}'.format(i)}}
+                 for i in range(start, end)]
+        payload = {'totalItems': self.total}
+        if items:
+            payload['items'] = items
+        return StubResponse(200, payload)
+
+    def request_event(self, start):
+        return self.requested.setdefault(start, threading.Event())
+
+# Tests iter_result_pages() and ResultPager
+class TestResultPages:
+    def test_pages_until_total_items(self):
+        client = PagedClient(95)
+        pages = list(iter_result_pages('anything', client=client))
+        assert [len(page) for page in pages] == [40, 40, 15]
+        assert [b.title for b in pages[2]][-1] == 'Book 94'
+        assert [call.get('startIndex', 0) for call in client.calls] == [0, 40, 80]
+        assert all(call['maxResults'] == 40 and call['fields'] == RESULT_FIELDS
+                   for call in client.calls)
+
+    def test_pages_fetched_on_demand(self):
+        client = PagedClient(95)
+        pages = iter_result_pages('anything', client=client)
+        next(pages)
+        assert len(client.calls) == 1
+
+    def test_pager_prefetches_near_end(self):
+        client = PagedClient(95)
+        pager = ResultPager('anything', page_size=5, fetch_size=40, client=client)
+        pager.current_page()
+        for _ in range(6):
+            pager.next_page()
+        assert len(client.calls) == 1
+        pager.next_page() # Last page of the first batch
+        assert client.request_event(40).wait(1)
+        assert not client.request_event(80).is_set()
+        assert [b.title for b in pager.next_page()][0] == 'Book 40'
+        assert len(client.calls) == 2
+        pager.close()
+
+    def test_pager_retries_failed_batch(self):
+        client = PagedClient(12)
+        client.failures.add(5)
+        with ResultPager('anything', page_size=5, fetch_size=5, client=client) as pager:
+            pager.current_page()
+            with pytest.raises(RuntimeError):
+                pager.next_page()
+            assert pager.first_entry == 0
+            assert [b.title for b in pager.next_page()][0] == 'Book 5'
+            assert [b.title for b in pager.next_page()] == ['Book 10', 'Book 11']
+
+    def test_pager_close_does_not_wait(self):
+        client = PagedClient(95)
+        client.gate = threading.Event()
+        release = threading.Timer(1, client.gate.set)
+        release.start()
+        start = time.perf_counter()
+        with ResultPager('anything', page_size=5, fetch_size=5, client=client) as pager:
+            pager.current_page()
+            assert client.request_event(5).wait(1)
+        assert time.perf_counter() - start < 0.5
+        release.join()
+
+    def test_failed_request_raises(self):
+        with pytest.raises(RuntimeError):
+            next(iter_result_pages('', client=StubClient({})))
+
+    def test_paged_requests_cached_separately(self):
+        client = PagedClient(95)
+        cache = ResponseCache()
+        first = query('anything', cache=cache, client=client, max_results=40)
+        second = query('anything', cache=cache, client=client, start_index=40, max_results=40)
+        assert first['items'][0]['id'] == '0' and second['items'][0]['id'] == '40'
+        query('anything', cache=cache, client=client, start_index=40, max_results=40)
+        assert len(client.calls) == 2
+
+    def test_pager_moves_between_pages(self):
+        client = PagedClient(12)
+        pager = ResultPager('anything', page_size=5, fetch_size=10, client=client)
+        assert [b.title for b in pager.current_page()][0] == 'Book 0'
+        assert [b.title for b in pager.next_page()][0] == 'Book 5'
+        assert [b.title for b in pager.next_page()] == ['Book 10', 'Book 11']
+        assert pager.first_entry == 10
+        assert pager.next_page() == []
+        assert [b.title for b in pager.previous_page()][0] == 'Book 5'
+        assert pager.previous_page() and pager.previous_page() == []
+        assert len(client.calls) == 2
+
+    def test_parse_json_limit(self):
+        assert len(parse_json(mistborn_query, limit=None)) == len(mistborn_query['items'])
+
+# Tests Book construction and serialization
+class TestBook:
+    def test_from_volume_extra_fields(self):
+        book = Book.from_volume(mistborn_query['items'][0])
+        assert (book.id, book.isbn_10, book.isbn_13) == ('L1WbngEACAAJ', '0765377136',
+                                                         '9780765377135')
+        assert (book.published_date, book.page_count) == ('2014-05-13', 672)
+
+    def test_book_is_slotted(self):
+        book = Book.from_volume(mistborn_query['items'][0])
+        assert not hasattr(book, '__dict__')
+
+    def test_repeated_strings_interned(self):
+        volumes = json.loads(json.dumps(mistborn_query['items'][:2]))
+        first, second = Book.from_volumes(volumes)
+        assert first.authors[0] is second.authors[0]
+
+    def test_json_round_trip(self, tmp_path):
+        books = parse_json(mistborn_query, limit=None)
+        path = tmp_path / 'books.jsonl'
+        with open(str(path), 'w') as f:
+            assert write_books(books, f) == len(books)
+        with open(str(path), 'r') as f:
+            assert list(read_books(f)) == books
+
+    def test_store_keeps_all_fields(self, tmp_path):
+        book = Book.from_volume(barbarian_query['items'][0])
+        with BookStore(str(tmp_path / 'booklist.db')) as store:
+            store.add(book)
+            assert list(store) == [book]
+
+    def test_store_upgrades_old_schema(self, tmp_path):
+        path = str(tmp_path / 'booklist.db')
+        conn = sqlite3.connect(path)
+        conn.execute("CREATE TABLE books (seq INTEGER PRIMARY KEY AUTOINCREMENT, "
+                     "id TEXT UNIQUE, isbn_10 TEXT, isbn_13 TEXT, title TEXT NOT NULL, "
+                     "authors TEXT NOT NULL, publisher TEXT NOT NULL)")
+        conn.execute("INSERT INTO books (title, authors, publisher) "
+                     "VALUES ('Old', '[\"A\"]', 'P')")
+        conn.commit()
+        conn.close()
+        with BookStore(path) as store:
+            assert list(store) == [Book('Old', ['A'], 'P')]
+
 # Tests add_book_to_list() function
 class TestAddBook:
     def test_add_book_to_booklist(self):
         books = parse_json(mistborn_query)
-        add_book_to_list(0, books, set(), booklist=TEST_BOOKLIST)
-        with open(TEST_BOOKLIST, 'r') as f:
-            lines = f.readlines()
-        assert (''.join(lines) == 
-                'Title: Mistborn\nAuthors: Brandon Sanderson\nPublisher: Tor Teen\n\n')
+        with BookStore(TEST_BOOKLIST) as store:
+            add_book_to_list(0, books, store)
+            assert (''.join(str(book) for book in store) == 
+                    'Title: Mistborn\nAuthors: Brandon Sanderson\nPublisher: Tor Teen\n\n')
 
     def test_append_book_to_end_of_booklist(self):
         books = parse_json(barbarian_query)
-        add_book_to_list(0, books, set(), booklist=TEST_BOOKLIST)
-        with open(TEST_BOOKLIST, 'r') as f:
-            lines = f.readlines()
-        assert (''.join(lines) == 
-                ('Title: Mistborn\nAuthors: Brandon Sanderson\nPublisher: Tor Teen\n\n' + 
-                 'Title: Barbarian Days\nAuthors: William Finnegan\nPublisher: Penguin\n\n'))
+        with BookStore(TEST_BOOKLIST) as store:
+            add_book_to_list(0, books, store)
+            assert (''.join(str(book) for book in store) == 
+                    ('Title: Mistborn\nAuthors: Brandon Sanderson\nPublisher: Tor Teen\n\n' + 
+                     'Title: Barbarian Days\nAuthors: William Finnegan\nPublisher: Penguin\n\n'))
+
+    def test_duplicate_book_not_added(self, tmp_path, capsys):
+        books = parse_json(mistborn_query)
+        with BookStore(str(tmp_path / 'booklist.db')) as store:
+            add_book_to_list(0, books, store)
+            add_book_to_list(0, books, store)
+            assert len(store) == 1
+        assert "Book already in list" in capsys.readouterr().out
+
+# Tests BookStore and migration from the text booklist
+class TestBookStore:
+    def test_same_title_different_volume_kept(self, tmp_path):
+        first, second = Book('Mistborn', ['A'], 'P', id='a'), Book('Mistborn', ['B'], 'P', id='b')
+        with BookStore(str(tmp_path / 'booklist.db')) as store:
+            assert store.add(first) and store.add(second)
+            assert not store.add(Book('Other title', ['A'], 'P', id='a'))
+
+    def test_duplicate_isbn_detected(self, tmp_path):
+        with BookStore(str(tmp_path / 'booklist.db')) as store:
+            store.add(Book('Mistborn', ['A'], 'P', id='a', isbn_13='9780765377135'))
+            assert Book('Mistborn', ['A'], 'P', id='b', isbn_13='9780765377135') in store
+
+    def test_find_by_fields(self, tmp_path):
+        with BookStore(str(tmp_path / 'booklist.db')) as store:
+            store.add_many(parse_json(mistborn_query) + parse_json(barbarian_query))
+            assert [b.title for b in store.find(author='Annie Parnell')] == [
+                "Missy Piggle-Wiggle and the Won't-Walk-the-Dog Cure"]
+            assert {b.title for b in store.find(publisher='Penguin')} == {'Barbarian Days'}
+            assert store.find(title='Mistborn')[0].isbn_13 == '9780765377135'
+            assert store.find(title='Mistborn', publisher='Penguin') == []
+
+    def test_migrates_text_booklist(self, tmp_path):
+        legacy = tmp_path / 'booklist.txt'
+        legacy.write_text('Title: Mistborn\nAuthors: Brandon Sanderson\nPublisher: Tor Teen\n\n' +
+                          'Title: Two\nLines\nAuthors: A, B\nPublisher: P\n\n')
+        path = str(tmp_path / 'booklist.db')
+        with open_booklist(path, str(legacy)) as store:
+            books = list(store)
+        assert [b.title for b in books] == ['Mistborn', 'Two\nLines']
+        assert books[1].authors == ['A', 'B']
+        assert not legacy.exists()
+        with open_booklist(path, str(legacy)) as store:
+            assert Book('Mistborn', ['Brandon Sanderson'], 'Tor Teen') in store
+            assert len(store) == 2
+
+# Tests several sessions sharing a booklist
+class TestConcurrentBooklist:
+    def test_other_session_adds_seen(self, tmp_path):
+        path = str(tmp_path / 'booklist.db')
+        book = Book.from_volume(mistborn_query['items'][0])
+        with BookStore(path) as first, BookStore(path) as second:
+            assert first.add(book)
+            assert book in second
+            assert not second.add(book)
+
+    def test_concurrent_writers_no_duplicates(self, tmp_path):
+        path = str(tmp_path / 'booklist.db')
+        BookStore(path).close()
+        shared = [Book('Shared {}'.format(i), ['A'], 'P', id='shared{}'.format(i))
+                  for i in range(50)]
+
+        def writer(name):
+            own = [Book('{} {}'.format(name, i), ['A'], 'P', id='{}{}'.format(name, i))
+                   for i in range(50)]
+            with BookStore(path) as store:
+                for book in shared + own:
+                    store.add(book)
+        threads = [threading.Thread(target=writer, args=(name,)) for name in 'abc']
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        with BookStore(path) as store:
+            ids = [book.id for book in store]
+        assert len(ids) == len(set(ids)) == 200
+
+    def test_failed_batch_writes_nothing(self, tmp_path):
+        def books():
+            yield Book.from_volume(mistborn_query['items'][0])
+            raise OSError("interrupted")
+        with BookStore(str(tmp_path / 'booklist.db')) as store:
+            with pytest.raises(OSError):
+                store.add_many(books())
+            assert len(store) == 0
+
+    def test_run_batch_flushes_in_batches(self, tmp_path, capsys):
+        terms = tmp_path / 'terms.txt'
+        terms.write_text('mistborn\nbarbarian\n')
+        client = StubClient({'mistborn': mistborn_query, 'barbarian': barbarian_query})
+        with BookStore(str(tmp_path / 'booklist.db')) as store:
+            calls = []
+            add_many = store.add_many
+
+            def counting_add_many(books):
+                calls.append(len(books))
+                return add_many(books)
+            store.add_many = counting_add_many
+            run_batch(str(terms), store, rate=None, client=client, flush_size=1)
+            assert calls == [1, 1, 0]
+            assert len(store) == 2
+        assert "2 books added" in capsys.readouterr().out
+
+# Tests view_list() and BookStore.iter_books()
+class TestViewList:
+    @pytest.fixture
+    def store(self, tmp_path):
+        with BookStore(str(tmp_path / 'booklist.db')) as store:
+            store.add_many(parse_json(mistborn_query) + parse_json(barbarian_query))
+            yield store
+
+    def test_empty_booklist(self, tmp_path, capsys):
+        with BookStore(str(tmp_path / 'booklist.db')) as store:
+            view_list(store)
+        assert "Booklist not yet created" in capsys.readouterr().out
+
+    def test_filter_by_author(self, store):
+        titles = [b.title for b in store.iter_books({'author': 'sanderson'})]
+        assert titles == ['Mistborn', 'Mistborn Trilogy']
+
+    def test_filter_escapes_wildcards(self, store):
+        assert list(store.iter_books({'title': '%'})) == []
+
+    def test_sort_limit_offset(self, store):
+        titles = [b.title for b in store.iter_books(sort='title')]
+        assert titles == sorted(titles)
+        assert [b.title for b in store.iter_books(sort='title', limit=2, offset=1)] == titles[1:3]
+
+    def test_sort_by_author(self, store):
+        authors = [b.authors[0] for b in store.iter_books(sort='author')]
+        assert authors == sorted(authors)
+
+    def test_view_filtered_list(self, store, capsys):
+        view_list(store, {'publisher': 'tor'}, sort='title', limit=1)
+        out = capsys.readouterr().out
+        assert 'Title: Mistborn\nAuthors: Brandon Sanderson\nPublisher: Tor Teen\n\n' in out
+        assert out.count('Title: ') == 1
+
+    def test_view_no_matches(self, store, capsys):
+        view_list(store, {'title': 'no such book'})
+        assert "No books in booklist match" in capsys.readouterr().out
+
+    def test_view_zero_limit(self, store, capsys):
+        view_list(store, limit=0)
+        assert "No books in booklist match" in capsys.readouterr().out
+
+    def test_view_stops_between_pages(self, store, capsys):
+        prompts = []
+
+        def more():
+            prompts.append(1)
+            return False
+        view_list(store, page_size=2, more=more)
+        assert capsys.readouterr().out.count('Title: ') == 2
+        assert len(prompts) == 1
+
+# Tests Metrics and the instrumentation hooks
+class TestMetrics:
+    @pytest.fixture
+    def enabled(self):
+        metrics.reset()
+        metrics.enable()
+        yield metrics
+        metrics.disable()
+        metrics.reset()
+
+    def test_nothing_recorded_when_disabled(self):
+        query('mistborn', cache=ResponseCache(), client=StubClient({'mistborn': mistborn_query}))
+        assert metrics.snapshot() == {'counters': {}, 'stages': {}}
+        assert metrics.timer('request') is metrics.timer('parse')
+
+    def test_query_and_parse_recorded(self, enabled):
+        client = StubClient({'mistborn': mistborn_query})
+        cache = ResponseCache()
+        parse_json(query('mistborn', cache=cache, client=client))
+        query('mistborn', cache=cache, client=client)
+        snapshot = enabled.snapshot()
+        assert snapshot['counters']['cache_misses'] == 1
+        assert snapshot['counters']['cache_hits'] == 1
+        assert snapshot['counters']['items_parsed'] == 5
+        assert snapshot['counters']['bytes_downloaded'] > 0
+        assert snapshot['stages']['request']['count'] == 1
+        assert snapshot['stages']['request']['buckets']['+Inf'] == 1
+        assert snapshot['stages']['decode']['count'] == 1
+
+    def test_booklist_writes_recorded(self, enabled, tmp_path):
+        with open_booklist(str(tmp_path / 'booklist.db'), str(tmp_path / 'none.txt')) as store:
+            store.add_many(parse_json(mistborn_query))
+        snapshot = enabled.snapshot()
+        assert snapshot['counters']['books_added'] == 5
+        assert snapshot['counters']['booklist_bytes_written'] > 0
+        assert set(snapshot['stages']) == {'parse', 'booklist_open', 'booklist_write'}
+
+    def test_bytes_downloaded_counts_compressed_size(self, enabled, local_server):
+        with BooksClient() as client:
+            query('mistborn', client=benchmarks.RedirectedClient(client, local_server.url))
+        compressed = len(gzip.compress(json.dumps(mistborn_query).encode('utf-8')))
+        assert enabled.snapshot()['counters']['bytes_downloaded'] == compressed
+
+    def test_rolled_back_writes_not_recorded(self, enabled, tmp_path):
+        books = parse_json(mistborn_query)
+        with open_booklist(str(tmp_path / 'booklist.db'), str(tmp_path / 'none.txt')) as store:
+            with pytest.raises(AttributeError):
+                store.add_many(books + [None])
+            assert len(store) == 0
+        assert 'books_added' not in enabled.snapshot()['counters']
+
+    def test_histogram_buckets(self, enabled):
+        for seconds in (0.0005, 0.001, 0.3, 60):
+            enabled.observe('request', seconds)
+        buckets = enabled.snapshot()['stages']['request']['buckets']
+        assert (buckets['0.001'], buckets['0.5'], buckets['10'], buckets['+Inf']) == (2, 3, 3, 4)
+
+    def test_exports(self, enabled, tmp_path):
+        enabled.count('cache_hits', 3)
+        enabled.observe('request', 0.02)
+        enabled.write(str(tmp_path / 'metrics.jsonl'))
+        enabled.write(str(tmp_path / 'metrics.jsonl'))
+        lines = (tmp_path / 'metrics.jsonl').read_text().splitlines()
+        assert len(lines) == 2 and json.loads(lines[0])['counters'] == {'cache_hits': 3}
+        enabled.write(str(tmp_path / 'metrics.prom'))
+        prom = (tmp_path / 'metrics.prom').read_text()
+        assert 'google_booklist_cache_hits_total 3\n' in prom
+        assert 'google_booklist_stage_seconds_bucket{stage="request",le="0.025"} 1\n' in prom
+        assert 'google_booklist_stage_seconds_count{stage="request"} 1\n' in prom
+
+# Makes sure the benchmark suite keeps running as the code changes
+class TestBenchmarks:
+    def test_small_run_writes_json(self, tmp_path):
+        output = tmp_path / 'results.json'
+        benchmarks.main(['--scale', '100', '--queries', '10', '--latency-ms', '0',
+                         '--sizes', '50', '--output', str(output)])
+        report = json.loads(output.read_text())
+        assert set(report['results']) == set(benchmarks.BENCHMARKS)
+        assert report['results']['booklist_scaling']['50']['view_first_output_ms']
+
+    def test_single_query_latency(self, tmp_path):
+        output = tmp_path / 'results.json'
+        benchmarks.main(['--queries', '1', '--latency-ms', '0', 'query_latency',
+                         '--output', str(output)])
+        for summary in json.loads(output.read_text())['results']['query_latency'].values():
+            assert summary['samples'] == 1 and summary['p50_ms'] == summary['p99_ms']
+
+    def test_selected_benchmarks_checked(self, tmp_path, capsys):
+        output = tmp_path / 'results.json'
+        benchmarks.main(['--scale', '100', 'parse_json', '--output', str(output)])
+        assert set(json.loads(output.read_text())['results']) == {'parse_json'}
+        with pytest.raises(SystemExit):
+            benchmarks.main(['parse_json', 'nope'])
+        assert 'unknown benchmark(s): nope' in capsys.readouterr().err
 
 # Cleans up side effects from testing
 class TestCleanUp: